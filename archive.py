@@ -0,0 +1,425 @@
+"""Append-only archive of every alert the reader sees.
+
+Alerts are written as JSON lines to one file per day,
+<directory>/YYYY/MM/YYYY-MM-DD.jsonl.gz, partitioned by the alert's own
+timestamp. Writes go through a queue to a background thread that appends
+a gzip member per batch, so the polling loop never waits on the disk, and a
+concatenation of gzip members is still a normal gzip file. A failed write
+is cut off the file again. A crash loses the batches that were still
+buffered, and a member it left half written is skipped when reading.
+
+Reading goes one day file at a time, so a month of history can be scanned
+without holding it in memory:
+
+    for alert in iter_alerts('archive', start=date(2024, 1, 1)):
+        ...
+
+AlertIndex keeps an SQLite index next to the files, with the words of every
+message and the service, region and time of every alert, so queries do not
+have to scan them (see query.py).
+"""
+import gzip
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+
+ARCHIVE_FIELDS = ('datetime', 'service', 'region', 'message', 'capcodes', 'published_at', 'seen_at')
+# The first bytes of every gzip member: magic number and deflate method.
+GZIP_HEADER = b'\x1f\x8b\x08'
+READ_CHUNK = 1 << 16
+_STOP = object()
+
+def partition_path(directory, day):
+    """Returns the archive file of a day."""
+    return os.path.join(directory, f"{day:%Y}", f"{day:%m}", f"{day:%Y-%m-%d}.jsonl.gz")
+
+def parse_partition(path):
+    """Returns the day of an archive file, or None if it is not one."""
+    name = os.path.basename(path)
+    if not name.endswith('.jsonl.gz'):
+        return None
+    try:
+        return datetime.strptime(name[:-len('.jsonl.gz')], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def partitions(directory, start=None, end=None):
+    """Returns (day, path) of the archive files between `start` and `end` (inclusive), oldest first."""
+    found = []
+    if not os.path.isdir(directory):
+        return found
+    for year in sorted(os.listdir(directory)):
+        year_dir = os.path.join(directory, year)
+        if not year.isdigit() or not os.path.isdir(year_dir):
+            continue
+        for month in sorted(os.listdir(year_dir)):
+            month_dir = os.path.join(year_dir, month)
+            if not os.path.isdir(month_dir):
+                continue
+            for name in sorted(os.listdir(month_dir)):
+                day = parse_partition(name)
+                if day is None or (start and day < start) or (end and day > end):
+                    continue
+                found.append((day, os.path.join(month_dir, name)))
+    return found
+
+def read_partition(path):
+    """Yields the alerts of one archive file in the order they were written, skipping damaged batches."""
+    for _, lines in read_members(path):
+        for line in lines:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+def iter_alerts(directory, start=None, end=None):
+    """Yields the archived alerts between the days `start` and `end` (inclusive), oldest day first."""
+    for _, path in partitions(directory, start, end):
+        yield from read_partition(path)
+
+def read_members(path, offset=0):
+    """Yields (end offset, lines) of every complete gzip member of an archive file after `offset`.
+
+    Bytes that do not decompress, like a member cut off by a crash with more
+    batches written after it, are skipped up to the next member that does.
+    Reading stops at a member that is not complete yet, so the offset of the
+    last complete one can be stored and reading resumed there later.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    view = memoryview(data)
+    start = 0
+    while start < len(data):
+        decompressor = zlib.decompressobj(wbits=31)
+        parts = []
+        position = start
+        try:
+            while not decompressor.eof and position < len(data):
+                parts.append(decompressor.decompress(view[position:position + READ_CHUNK]))
+                position += READ_CHUNK
+            lines = [line for line in b''.join(parts).decode('utf-8').splitlines() if line.strip()]
+        except (zlib.error, UnicodeDecodeError):
+            lines = None
+        if lines is None or not decompressor.eof:
+            start = data.find(GZIP_HEADER, start + 1)
+            if start < 0:
+                return
+            continue
+        start = min(position, len(data)) - len(decompressor.unused_data)
+        yield offset + start, lines
+
+WORD_RE = re.compile(r'\w+')
+
+def words(text):
+    """Returns the distinct lowercase words of a text, which is what the index matches on."""
+    return set(WORD_RE.findall(text.lower())) if text else set()
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY,
+    time INTEGER NOT NULL,
+    service TEXT COLLATE NOCASE,
+    region TEXT COLLATE NOCASE,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS alerts_time ON alerts (time);
+CREATE INDEX IF NOT EXISTS alerts_service ON alerts (service, time);
+CREATE INDEX IF NOT EXISTS alerts_region ON alerts (region, time);
+CREATE TABLE IF NOT EXISTS postings (
+    word TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    alert INTEGER NOT NULL,
+    PRIMARY KEY (word, time, alert)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS words (word TEXT PRIMARY KEY, alerts INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, offset INTEGER NOT NULL) WITHOUT ROWID;
+"""
+
+class AlertIndex:
+    """An SQLite index over the archive files of a directory.
+
+    Every alert gets a row with its service, region and time (the published
+    time, or when it was seen), each with its own index, and a posting per
+    word of its message. Postings are ordered by word and time, so a query
+    reads only the alerts of its rarest word within the time range, newest
+    first, and checks the other words with one lookup each.
+
+    The index remembers how far it has read every archive file. update()
+    indexes the gzip members appended since then, so the archive writer can
+    keep it current after every batch and the query tool can catch it up
+    (or rebuild it after it was deleted) from the files themselves.
+    """
+
+    def __init__(self, path, directory):
+        self.path = path
+        self.directory = directory
+        self._conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(INDEX_SCHEMA)
+
+    def update(self, paths=None):
+        """Indexes what was appended to the archive files (all of them by default); returns the new alert count."""
+        if paths is None:
+            paths = [path for _, path in partitions(self.directory)]
+        return sum(self._update_file(path) for path in paths)
+
+    def _offset(self, name):
+        row = self._conn.execute("SELECT offset FROM files WHERE path = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _update_file(self, path):
+        name = os.path.relpath(path, self.directory)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return 0
+        if self._offset(name) >= size:
+            return 0
+        count = 0
+        # The writer thread and the query tool may both update the index, so
+        # the offset is read again once the write lock is held.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            offset = self._offset(name)
+            for offset, lines in read_members(path, offset):
+                self._add(lines)
+                count += len(lines)
+            self._conn.execute("INSERT OR REPLACE INTO files (path, offset) VALUES (?, ?)", (name, offset))
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return count
+
+    def _add(self, lines):
+        postings = []
+        counts = {}
+        for line in lines:
+            record = json.loads(line)
+            timestamp = int(record.get('published_at') or record['seen_at'])
+            alert_id = self._conn.execute(
+                "INSERT INTO alerts (time, service, region, record) VALUES (?, ?, ?, ?)",
+                (timestamp, record.get('service'), record.get('region'), line)).lastrowid
+            for word in words(record.get('message')):
+                postings.append((word, timestamp, alert_id))
+                counts[word] = counts.get(word, 0) + 1
+        self._conn.executemany("INSERT INTO postings (word, time, alert) VALUES (?, ?, ?)", postings)
+        self._conn.executemany(
+            "INSERT INTO words (word, alerts) VALUES (?, ?) ON CONFLICT (word) DO UPDATE SET alerts = alerts + ?",
+            [(word, count, count) for word, count in counts.items()])
+
+    def _where(self, text, service, region, since, until):
+        """Returns the FROM and WHERE clause and parameters of a query, or None if nothing can match."""
+        query_words = words(text)
+        frequency = {}
+        for word in query_words:
+            row = self._conn.execute("SELECT alerts FROM words WHERE word = ?", (word,)).fetchone()
+            if not row:
+                return None
+            frequency[word] = row[0]
+        query_words = sorted(query_words, key=frequency.get)
+
+        if query_words:
+            # CROSS JOIN keeps the postings of the rarest word as the outer loop.
+            clause = "FROM postings p CROSS JOIN alerts a ON a.id = p.alert WHERE p.word = ?"
+            params = [query_words[0]]
+            time_column = 'p.time'
+        else:
+            clause = "FROM alerts a WHERE 1"
+            params = []
+            time_column = 'a.time'
+        if since is not None:
+            clause += f" AND {time_column} >= ?"
+            params.append(int(since))
+        if until is not None:
+            clause += f" AND {time_column} < ?"
+            params.append(int(until))
+        for word in query_words[1:]:
+            clause += " AND EXISTS (SELECT 1 FROM postings WHERE word = ? AND time = p.time AND alert = p.alert)"
+            params.append(word)
+        if service:
+            clause += " AND a.service = ?"
+            params.append(service)
+        if region:
+            clause += " AND a.region = ?"
+            params.append(region)
+        return clause, params, time_column
+
+    def search(self, text=None, service=None, region=None, since=None, until=None, limit=50):
+        """Returns the alerts with all words of `text` that match the filters, newest first.
+
+        `service` and `region` match case-insensitively, `since` and `until`
+        are Unix timestamps (`until` exclusive).
+        """
+        where = self._where(text, service, region, since, until)
+        if where is None:
+            return []
+        clause, params, time_column = where
+        sql = f"SELECT a.record {clause} ORDER BY {time_column} DESC, a.id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [json.loads(record) for record, in self._conn.execute(sql, params)]
+
+    def count(self, text=None, service=None, region=None, since=None, until=None):
+        """Returns how many alerts search() would find without a limit."""
+        where = self._where(text, service, region, since, until)
+        if where is None:
+            return 0
+        clause, params, _ = where
+        return self._conn.execute(f"SELECT count(*) {clause}", params).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+class AlertArchive:
+    """Buffers alerts and appends them to the day files on a writer thread.
+
+    A batch is written once `batch_size` alerts are buffered or the oldest
+    buffered alert is `flush_interval` seconds old. When the writer falls
+    behind and the queue is full, alerts are dropped and counted rather than
+    blocking the caller. With an `index_path` the writer also brings that
+    AlertIndex up to date after every batch.
+    """
+
+    def __init__(self, directory, timezone=None, batch_size=500, flush_interval=60, max_queue=10000,
+                 compresslevel=6, index_path=None):
+        self.directory = directory
+        self.index_path = index_path
+        self.timezone = timezone
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="alert-archive", daemon=True)
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.bytes_written = 0
+        self.indexed = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, alert, seen_at=None):
+        """Queues an alert for the archive; returns False if it was dropped."""
+        record = {field: alert.get(field) for field in ARCHIVE_FIELDS}
+        record['seen_at'] = seen_at if seen_at is not None else alert.get('seen_at', time.time())
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _day(self, record):
+        timestamp = record.get('published_at') or record['seen_at']
+        return datetime.fromtimestamp(timestamp, self.timezone).date()
+
+    def _open_index(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            return AlertIndex(self.index_path, self.directory)
+        except (sqlite3.Error, OSError) as e:
+            print(f"--> Failed to open the archive index {self.index_path}, not indexing: {e}")
+            return None
+
+    def _run(self):
+        # SQLite connections belong to the thread that opened them.
+        index = self._open_index() if self.index_path else None
+        try:
+            self._loop(index)
+        finally:
+            if index is not None:
+                index.close()
+
+    def _loop(self, index):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # The flush interval of the buffered batch is over.
+                record = None
+            if record is _STOP:
+                self._flush(batch, index)
+                return
+            if record is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(record)
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch, index)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch, index):
+        paths = self._write(batch)
+        if index is None or not paths:
+            return
+        try:
+            self.indexed += index.update(paths)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            print(f"--> Failed to index {len(batch)} archived alert(s), the query tool will catch up: {e}")
+
+    def _write(self, batch):
+        """Appends a batch to the day files and returns the paths written."""
+        paths = []
+        by_day = {}
+        for record in batch:
+            by_day.setdefault(self._day(record), []).append(record)
+        for day, records in by_day.items():
+            path = partition_path(self.directory, day)
+            data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            block = gzip.compress(data.encode('utf-8'), compresslevel=self.compresslevel)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'ab', buffering=0) as f:
+                    end = f.tell()
+                    try:
+                        written = 0
+                        while written < len(block):
+                            written += f.write(block[written:])
+                    except OSError:
+                        # A half-written member would be appended to by the next batch.
+                        f.truncate(end)
+                        raise
+            except OSError as e:
+                self.dropped += len(records)
+                print(f"--> Failed to write {len(records)} alert(s) to the archive: {e}")
+                continue
+            self.written += len(records)
+            self.batches += 1
+            self.bytes_written += len(block)
+            paths.append(path)
+        return paths
+
+    def collect(self):
+        """Returns the archive's metric samples."""
+        return [
+            ('p2000_archive_written_total', {}, self.written),
+            ('p2000_archive_dropped_total', {}, self.dropped),
+            ('p2000_archive_bytes_total', {}, self.bytes_written),
+            ('p2000_archive_indexed_total', {}, self.indexed),
+            ('p2000_archive_queue_depth', {}, self._queue.qsize()),
+        ]
+
+    def close(self, timeout=None):
+        """Writes what is buffered and stops the writer thread."""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
@@ -0,0 +1,201 @@
+"""Offline benchmark of the per-poll work in main.py, using the recorded pages in pages/.
+
+Every stage of a poll is timed separately for every page: decode, parse
+(once per parser backend, plus an incremental parse that stops at a
+watermark), dedup, delta detection, location matching and routing to
+subscribers. Allocations are measured with tracemalloc. The parser backends
+are checked to return the same alerts, for full and incremental parses,
+before they are timed.
+
+    python benchmarks/bench_pipeline.py --output bench.json
+    python benchmarks/bench_pipeline.py --compare bench.json
+
+With --compare the run fails (exit code 1) when the fastest run of a stage
+got slower than --threshold times the fastest run in the earlier results.
+Differences below --min-delta are treated as noise.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import main
+
+# Alerts that are "new" when measuring incremental parsing and delta detection.
+NEW_ALERTS = 5
+# Size of the large keyword list, to show how matching scales with locations.
+MANY_LOCATIONS = 500
+# Size of the subscriber table, to show how routing scales with subscribers.
+MANY_SUBSCRIBERS = 200
+
+def measure(func, repeat):
+    """Returns timing and allocation statistics for calling `func` `repeat` times."""
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        func()
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename') if stat.size_diff > 0)
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "runs": repeat,
+        "peak_bytes": peak,
+        "retained_bytes": allocated,
+        "retained_blocks": blocks,
+    }
+
+def many_locations():
+    """Returns DEFAULT_LOCATIONS padded with made-up place names."""
+    filler = [f"plaats{i:03d}" for i in range(MANY_LOCATIONS - len(main.DEFAULT_LOCATIONS))]
+    return list(main.DEFAULT_LOCATIONS) + filler
+
+def many_subscribers():
+    """Returns subscribers with five locations each, drawn from many_locations()."""
+    locations = many_locations()
+    return [
+        {"topic": f"topic{i:03d}", "keywords": [locations[(i * 5 + j) % len(locations)] for j in range(5)]}
+        for i in range(MANY_SUBSCRIBERS)
+    ]
+
+def bench_page(path, repeat):
+    with open(path, 'rb') as f:
+        content = f.read()
+    text = content.decode('windows-1252', errors='replace')
+
+    backends = {name: main.PARSER_BACKENDS[name] for name in main.available_parsers()}
+    reference = main.parse_alerts_soup if 'soup' in backends else main.parse_alerts_stream
+    raw = reference(text)
+    identical = all(parse(text) == raw for parse in backends.values())
+
+    alerts = main.dedupe_alerts(raw)
+    watermark = None
+    if len(alerts) > NEW_ALERTS:
+        watermark = (alerts[NEW_ALERTS]['datetime'], alerts[NEW_ALERTS]['message'])
+        incremental = reference(text, stop_at=watermark)
+        identical = identical and all(parse(text, stop_at=watermark) == incremental for parse in backends.values())
+
+    def delta(bloom=False):
+        tracker = main.AlertDeltaTracker(bloom=bloom)
+        tracker.watermarks[None] = watermark
+        tracker.new_alerts(alerts)
+
+    default_matcher = main.LocationMatcher(main.DEFAULT_LOCATIONS)
+    large_matcher = main.LocationMatcher(many_locations())
+    subscribers = main.SubscriberIndex(many_subscribers())
+
+    stages = {"decode": lambda: content.decode('windows-1252', errors='replace')}
+    for name, parse in backends.items():
+        stages[f"parse[{name}]"] = lambda parse=parse: parse(text)
+        if watermark is not None:
+            stages[f"parse_incremental[{name}]"] = lambda parse=parse: parse(text, stop_at=watermark)
+    stages["dedup"] = lambda: main.dedupe_alerts(raw)
+    stages["delta"] = delta
+    stages["delta[bloom]"] = lambda: delta(bloom=True)
+    stages["match"] = lambda: [default_matcher.match(alert) for alert in alerts]
+    stages[f"match[{MANY_LOCATIONS}_locations]"] = lambda: [large_matcher.match(alert) for alert in alerts]
+    stages[f"route[{MANY_SUBSCRIBERS}_subscribers]"] = lambda: [subscribers.route(alert) for alert in alerts]
+
+    results = {}
+    for stage, func in stages.items():
+        result = measure(func, repeat)
+        result["alerts_per_second"] = len(alerts) / result["median"] if result["median"] else None
+        if stage == "decode" or stage.startswith("parse["):
+            result["megabytes_per_second"] = len(content) / 1e6 / result["median"] if result["median"] else None
+        results[stage] = result
+
+    return {
+        "bytes": len(content),
+        "rows": len(raw),
+        "alerts": len(alerts),
+        "backends_identical": identical,
+        "stages": results,
+    }
+
+def compare(results, baseline, threshold, min_delta):
+    """Returns a description of every stage that got slower than `threshold` times the baseline."""
+    regressions = []
+    for page, page_results in results["pages"].items():
+        for stage, result in page_results["stages"].items():
+            old = baseline.get("pages", {}).get(page, {}).get("stages", {}).get(stage)
+            if not old or not old["min"] or result["min"] - old["min"] < min_delta:
+                continue
+            if result["min"] / old["min"] > threshold:
+                regressions.append(
+                    f"{page} {stage}: {old['min'] * 1e3:.3f} ms -> {result['min'] * 1e3:.3f} ms "
+                    f"({result['min'] / old['min']:.2f}x)")
+    return regressions
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', default=os.path.join(BENCH_DIR, 'pages', '*.html'),
+                        help="glob of the recorded pages to benchmark")
+    parser.add_argument('--repeat', type=int, default=20, help="timed runs per stage")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help="earlier JSON results to check for regressions")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="slowdown factor that counts as a regression (default 1.25)")
+    parser.add_argument('--min-delta', type=float, default=0.0002,
+                        help="slowdowns smaller than this many seconds are ignored (default 0.0002)")
+    args = parser.parse_args(argv)
+
+    paths = sorted(glob.glob(args.pages))
+    if not paths:
+        parser.error(f"no pages match {args.pages}")
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parsers": main.available_parsers(),
+        "pages": {},
+    }
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        print(f"Benchmarking {name}...", file=sys.stderr)
+        results["pages"][name] = bench_page(path, args.repeat)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    failed = False
+    for name, page_results in results["pages"].items():
+        if not page_results["backends_identical"]:
+            print(f"Parser backends disagree on {name}", file=sys.stderr)
+            failed = True
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold, args.min_delta)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        failed = failed or bool(regressions)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
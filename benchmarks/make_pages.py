@@ -0,0 +1,79 @@
+"""Generates the recorded-page corpus used by bench_pipeline.py.
+
+The pages follow the markup of http://www.p2000-online.net/p2000.py: one
+<tr> per alert with DT, Am/Br/Po, Regio and Md/Mdx cells, followed by a row
+per capcode. The output is deterministic, so the corpus can be regenerated
+after changing this script.
+"""
+import os
+import random
+from datetime import datetime, timedelta
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages')
+
+SERVICES = [('Am', 'Ambulance'), ('Br', 'Brandweer'), ('Po', 'Politie')]
+REGIONS = ['Haaglanden', 'Rotterdam-Rijnmond', 'Hollands Midden', 'Utrecht', 'Amsterdam-Amstelland', 'Kennemerland']
+PLACES = ['Zoetermeer', 'ZOETMR', 'Delft', 'DELFT', 'Bleiswijk', 'BLEISW', "'s-Gravenhage", 'Rotterdam',
+          'Leiden', 'Gouda', 'Rijswijk', 'Pijnacker', 'Leidschendam', 'Westland', 'Schiedam']
+STREETS = ['Dorpsstraat', 'Markt', 'Stationsplein', 'Oosterheemplein', 'Voorweg', 'Hoofdweg', 'Kerkstraat']
+MESSAGES = {
+    'Am': ['A1 {unit} Rit {ride} {street} {place}', 'A2 {unit} {street} {place} {ride}', 'B {unit} Rit {ride} {place}'],
+    'Br': ['P 1 BDH-{nr:02d} Gebouwbrand {street} {place} {ride}', 'P 2 BDH-{nr:02d} Dienstverlening {street} {place}',
+           'Prio 1 Brand wegvervoer {street} {place} {ride}'],
+    'Po': ['P 1 Assistentie politie {street} {place}', 'Prio 2 Verkeersongeval {street} {place} {ride}'],
+}
+
+def alert_rows(rng, index, timestamp):
+    code, service = rng.choice(SERVICES)
+    message = rng.choice(MESSAGES[code]).format(
+        unit=rng.randint(10000, 19999), ride=rng.randint(100000, 999999), nr=rng.randint(1, 30),
+        street=rng.choice(STREETS), place=rng.choice(PLACES))
+    message_class = 'Mdx' if index % 7 == 0 else 'Md'
+    rows = [
+        f'<tr><td class="DT">{timestamp}</td><td class="{code}">{service}</td>'
+        f'<td class="Regio">{rng.choice(REGIONS)}</td><td class="{message_class}">{message}</td></tr>'
+    ]
+    for _ in range(rng.randint(1, 4)):
+        rows.append(f'<tr><td></td><td></td><td></td><td class="Oms">{rng.randint(1000000, 2999999):07d} '
+                    f'{service} {rng.choice(PLACES)}</td></tr>')
+    return rows
+
+def page(rows, rng, malformed=False):
+    lines = []
+    published = datetime(2026, 10, 18, 13, 59, 59)
+    for index in range(rows):
+        alert = alert_rows(rng, index, published.strftime('%d-%m-%y %H:%M:%S'))
+        if malformed and index % 5 == 1:
+            alert[0] = alert[0].replace('</td><td class="Regio">', '<td class="Regio">').replace('</tr>', '')
+        if malformed and index % 5 == 3:
+            alert[0] = alert[0].replace(' Markt ', ' Markt &amp; Kerk &#150; <b>spoed</b></span> ')
+        if malformed and index % 11 == 0:
+            # A repeated alert, as the site shows when a message is sent to several capcode groups.
+            alert = alert + alert[:1]
+        lines.extend(alert)
+        published -= timedelta(seconds=rng.randint(0, 40))
+    return (
+        '<html><head><title>P2000 Alle Regios</title>'
+        '<meta http-equiv="Content-Type" content="text/html; charset=windows-1252"></head>\n'
+        '<body><table style="width:100%">\n' + '\n'.join(lines) + '\n</table>'
+        + ('' if malformed else '</body></html>') + '\n'
+    )
+
+CORPUS = {
+    'quiet': dict(rows=15),
+    'busy': dict(rows=150),
+    'malformed': dict(rows=100, malformed=True),
+    'long': dict(rows=2000),
+}
+
+def main():
+    os.makedirs(PAGES_DIR, exist_ok=True)
+    for name, options in CORPUS.items():
+        rng = random.Random(name)
+        html = page(options['rows'], rng, options.get('malformed', False))
+        with open(os.path.join(PAGES_DIR, f"{name}.html"), 'wb') as f:
+            f.write(html.encode('windows-1252'))
+        print(f"Wrote {name}.html ({options['rows']} alerts, {len(html)} bytes)")
+
+if __name__ == "__main__":
+    main()
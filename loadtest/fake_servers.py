@@ -0,0 +1,265 @@
+"""Local stand-ins for p2000-online.net and ntfy.sh, for load and soak tests.
+
+FakeP2000 replays a recorded alert stream (any page from benchmarks/pages)
+as if the alerts were being published live: alerts are released at a steady
+rate with optional burst storms, stamped with the current time, and served
+newest first on /p2000.py in the same markup as the real site.
+
+FakeNtfy accepts notification posts on /<topic> and can inject latency,
+error responses, 429 rate limiting and timeouts. Both record what they
+published and received, so a soak test can count missed alerts and measure
+notification latency.
+
+    python loadtest/fake_servers.py --rate 2 --burst-every 60 --burst-size 40 --ntfy-error-rate 0.05
+
+Then run main.py with P2000_URL=http://127.0.0.1:8080/p2000.py and
+NTFY_URL=http://127.0.0.1:8081.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(LOADTEST_DIR))
+
+import main
+
+DEFAULT_RECORDING = os.path.join(os.path.dirname(LOADTEST_DIR), 'benchmarks', 'pages', 'long.html')
+
+def load_recording(path):
+    """Returns the alerts of a recorded page, oldest first."""
+    with open(path, 'rb') as f:
+        text = f.read().decode('windows-1252', errors='replace')
+    return list(reversed(main.dedupe_alerts(main.parse_alerts_stream(text))))
+
+class QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class FakeP2000:
+    """Publishes a recorded alert stream and serves it like p2000.py."""
+
+    def __init__(self, recording, rate=1.0, burst_every=0, burst_size=0, page_size=100, port=8080):
+        self.recording = recording
+        self.rate = rate
+        self.burst_every = burst_every
+        self.burst_size = burst_size
+        self.page_size = page_size
+        self.port = port
+        self.published = []
+        self._lock = threading.Lock()
+        self._page = b''
+        self._last_modified = formatdate(usegmt=True)
+        self._sequence = 0
+        self._stopped = threading.Event()
+        self._server = None
+        self.first_request = threading.Event()
+
+    def publish(self, count=1, backlog=False):
+        """Publishes the next `count` alerts of the recording.
+
+        `backlog` marks alerts that were already on the page when the test
+        started; main.py is not expected to notify about those.
+        """
+        now = time.time()
+        stamp = datetime.fromtimestamp(now, main._timezone).strftime('%d-%m-%y %H:%M:%S')
+        with self._lock:
+            for _ in range(count):
+                source = self.recording[self._sequence % len(self.recording)]
+                self._sequence += 1
+                # The sequence number keeps every replayed message unique, so
+                # deliveries can be matched to publications.
+                alert = dict(source, datetime=stamp, message=f"{source['message']} #{self._sequence}")
+                self.published.append(dict(alert, published_at=now, backlog=backlog))
+            page = main.render_page(self.published[-self.page_size:][::-1])
+            self._page = page.encode('windows-1252', errors='replace')
+            self._last_modified = formatdate(now, usegmt=True)
+
+    def _run(self):
+        start = time.monotonic()
+        next_alert = start
+        next_burst = start + self.burst_every if self.burst_every else None
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            if self.rate > 0 and now >= next_alert:
+                self.publish()
+                next_alert += 1 / self.rate
+            if next_burst is not None and now >= next_burst:
+                self.publish(self.burst_size)
+                next_burst += self.burst_every
+            wake = min(t for t in (next_alert if self.rate > 0 else None, next_burst, now + 0.5) if t is not None)
+            self._stopped.wait(max(0, wake - time.monotonic()))
+
+    def handler(self):
+        fake = self
+
+        class Handler(QuietHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/p2000.py':
+                    self.send_error(404)
+                    return
+                with fake._lock:
+                    body, last_modified, etag = fake._page, fake._last_modified, f'"{fake._sequence}"'
+                fake.first_request.set()
+                # Last-Modified only has second resolution, so like a real
+                # server the ETag takes precedence when both are sent.
+                if self.headers.get('If-None-Match') is not None:
+                    not_modified = self.headers.get('If-None-Match') == etag
+                else:
+                    not_modified = self.headers.get('If-Modified-Since') == last_modified
+                if not_modified:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=windows-1252')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self, publishing=True):
+        self.publish(min(self.page_size, len(self.recording)), backlog=True)
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), self.handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-p2000", daemon=True).start()
+        if publishing:
+            self.start_publishing()
+        return self
+
+    def start_publishing(self):
+        threading.Thread(target=self._run, name="fake-p2000-publisher", daemon=True).start()
+
+    def stop_publishing(self):
+        self._stopped.set()
+
+    def stop(self):
+        self.stop_publishing()
+        if self._server is not None:
+            self._server.shutdown()
+
+class FakeNtfy:
+    """Accepts ntfy posts, optionally slowly, failing or rate limited."""
+
+    def __init__(self, port=8081, latency=(0.0, 0.0), error_rate=0.0, rate_limit_rate=0.0,
+                 timeout_rate=0.0, timeout=30.0, seed=None):
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.received = []
+        self.responses = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _outcome(self):
+        with self._lock:
+            roll = self._random.random()
+            delay = self._random.uniform(*self.latency)
+        if roll < self.timeout_rate:
+            return 'timeout', self.timeout
+        roll -= self.timeout_rate
+        if roll < self.error_rate:
+            return 500, delay
+        roll -= self.error_rate
+        if roll < self.rate_limit_rate:
+            return 429, delay
+        return 200, delay
+
+    def handler(self):
+        fake = self
+
+        class Handler(QuietHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, delay = fake._outcome()
+                time.sleep(delay)
+                with fake._lock:
+                    fake.responses[status] = fake.responses.get(status, 0) + 1
+                if status == 'timeout':
+                    return
+                if status == 200:
+                    with fake._lock:
+                        fake.received.append({
+                            "topic": self.path.lstrip('/'),
+                            "title": self.headers.get('Title'),
+                            "priority": self.headers.get('Priority'),
+                            "body": body.decode('utf-8', errors='replace'),
+                            "received_at": time.time(),
+                        })
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        return Handler
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), self.handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-ntfy", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+def parse_range(value):
+    """Parses 'low-high' or a single number into a (low, high) tuple of seconds."""
+    low, _, high = value.partition('-')
+    return float(low), float(high or low)
+
+def add_arguments(parser):
+    parser.add_argument('--recording', default=DEFAULT_RECORDING, help="recorded page to replay")
+    parser.add_argument('--p2000-port', type=int, default=8080)
+    parser.add_argument('--ntfy-port', type=int, default=8081)
+    parser.add_argument('--rate', type=float, default=1.0, help="alerts published per second")
+    parser.add_argument('--burst-every', type=float, default=0, help="seconds between burst storms (0: none)")
+    parser.add_argument('--burst-size', type=int, default=0, help="alerts published in one burst")
+    parser.add_argument('--page-size', type=int, default=100, help="alerts shown on the page")
+    parser.add_argument('--ntfy-latency', type=parse_range, default=(0.0, 0.0), help="response delay, e.g. 0.05-0.5")
+    parser.add_argument('--ntfy-error-rate', type=float, default=0.0, help="fraction of posts answered with 500")
+    parser.add_argument('--ntfy-429-rate', type=float, default=0.0, help="fraction of posts answered with 429")
+    parser.add_argument('--ntfy-timeout-rate', type=float, default=0.0, help="fraction of posts that never get an answer")
+
+def start_servers(args, publishing=True):
+    p2000 = FakeP2000(load_recording(args.recording), rate=args.rate, burst_every=args.burst_every,
+                      burst_size=args.burst_size, page_size=args.page_size,
+                      port=args.p2000_port).start(publishing)
+    ntfy = FakeNtfy(port=args.ntfy_port, latency=args.ntfy_latency, error_rate=args.ntfy_error_rate,
+                    rate_limit_rate=args.ntfy_429_rate, timeout_rate=args.ntfy_timeout_rate).start()
+    return p2000, ntfy
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    p2000, ntfy = start_servers(args)
+    print(f"Fake p2000-online.net on http://127.0.0.1:{args.p2000_port}/p2000.py")
+    print(f"Fake ntfy on http://127.0.0.1:{args.ntfy_port}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"{len(p2000.published)} alerts published, {len(ntfy.received)} notifications received, "
+                  f"responses {ntfy.responses}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        p2000.stop()
+        ntfy.stop()
+
+if __name__ == "__main__":
+    main_cli()
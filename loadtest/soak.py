@@ -0,0 +1,209 @@
+"""Soak test: runs main.py against the fake servers and reports what got lost.
+
+The fake p2000-online.net and ntfy servers run in this process and main.py
+runs as a child process pointed at them. After --duration seconds the child
+is stopped with SIGTERM (so it flushes its notification queue) and a JSON
+report is printed with:
+
+- alerts published, alerts that should have matched, notifications delivered
+- missed and duplicated notifications, and what was left in the outbox
+- notification latency from publication to ntfy receiving it
+- resident memory of main.py over the run
+
+    python loadtest/soak.py --duration 3600 --rate 2 --burst-every 300 --burst-size 50 --ntfy-error-rate 0.05
+"""
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, LOADTEST_DIR)
+
+import fake_servers
+from fake_servers import main
+
+SOAK_TOPIC = 'soak'
+
+def rss_kib(pid):
+    """Returns the resident memory of a process in KiB, or None if it cannot be read."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def outbox_messages(path):
+    """Returns the messages main.py left in its outbox, as (pending, dead-lettered) lists."""
+    if not os.path.exists(path):
+        return [], []
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT alert, dead FROM outbox ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    pending = [json.loads(alert)['message'] for alert, dead in rows if not dead]
+    dead = [json.loads(alert)['message'] for alert, dead in rows if dead]
+    return pending, dead
+
+def report(p2000, ntfy, locations, outbox, memory, duration):
+    matcher = main.LocationMatcher(locations)
+    expected = {
+        alert['message']: alert for alert in p2000.published
+        if not alert['backlog'] and matcher.match(alert)
+    }
+
+    published = {alert['message'] for alert in p2000.published}
+    delivered = {}
+    duplicates = []
+    coalesced = 0
+    for notification in ntfy.received:
+        # A coalesced notification has one line per alert.
+        messages = notification['body'].split('\n\n', 1)[0].split('\n')
+        if notification['topic'] != SOAK_TOPIC or messages[0] not in published:
+            # Startup and shutdown notifications, or another subscriber's.
+            continue
+        coalesced += len(messages) - 1
+        for message in messages:
+            if message in delivered:
+                duplicates.append(message)
+            else:
+                delivered[message] = notification
+    pending, dead = outbox_messages(outbox)
+    # Notifications still waiting for a retry are sent on the next start, so
+    # they are reported separately from the ones that were lost.
+    missed = [message for message in expected if message not in delivered and message not in pending]
+
+    latencies = [
+        delivered[message]['received_at'] - alert['published_at']
+        for message, alert in expected.items() if message in delivered
+    ]
+    memory_values = [kib for _, kib in memory if kib is not None]
+
+    return {
+        "duration_seconds": duration,
+        "alerts_published": sum(1 for alert in p2000.published if not alert['backlog']),
+        "alerts_expected_to_match": len(expected),
+        "notifications_delivered": len(delivered),
+        "notifications_missed": len(missed),
+        "notifications_duplicated": len(duplicates),
+        "alerts_coalesced": coalesced,
+        "notifications_left_in_outbox": len(pending),
+        "notifications_dead_lettered": len(dead),
+        "missed": missed[:20],
+        "duplicated": duplicates[:20],
+        "ntfy_responses": {str(status): count for status, count in ntfy.responses.items()},
+        "notification_latency_seconds": {
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else None,
+        },
+        "rss_kib": {
+            "start": memory_values[0] if memory_values else None,
+            "end": memory_values[-1] if memory_values else None,
+            "max": max(memory_values) if memory_values else None,
+        },
+        "rss_samples": memory,
+    }
+
+def stop_child(child):
+    child.send_signal(signal.SIGTERM)
+    try:
+        child.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        child.kill()
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_servers.add_arguments(parser)
+    parser.add_argument('--duration', type=float, default=3600, help="seconds to run main.py")
+    parser.add_argument('--memory-interval', type=float, default=10, help="seconds between memory samples")
+    parser.add_argument('--locations', default=','.join(main.DEFAULT_LOCATIONS),
+                        help="P2000_LOCATIONS for main.py")
+    parser.add_argument('--restart-every', type=float, default=0,
+                        help="restart main.py every this many seconds (0: never)")
+    parser.add_argument('--settle', type=float, default=10,
+                        help="seconds main.py keeps running after publishing stops")
+    parser.add_argument('--log', default=os.devnull, help="file for main.py's output")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    p2000, ntfy = fake_servers.start_servers(args, publishing=False)
+    workdir = tempfile.mkdtemp(prefix='p2000-soak-')
+    outbox = os.path.join(workdir, 'outbox.sqlite3')
+    env = dict(
+        os.environ,
+        P2000_URL=f"http://127.0.0.1:{args.p2000_port}/p2000.py",
+        NTFY_URL=f"http://127.0.0.1:{args.ntfy_port}",
+        NTFY_TOPIC=SOAK_TOPIC,
+        NTFY_OUTBOX=outbox,
+        P2000_SEEN_STORE=os.environ.get('P2000_SEEN_STORE', os.path.join(workdir, 'seen.sqlite3')),
+        P2000_ARCHIVE_DIR=os.environ.get('P2000_ARCHIVE_DIR', os.path.join(workdir, 'archive')),
+        P2000_LOCATIONS=args.locations,
+        TERM=os.environ.get('TERM', 'dumb'),
+    )
+
+    memory = []
+    restarts = 0
+    started = time.monotonic()
+    with open(args.log, 'w') as log:
+        def start_child():
+            return subprocess.Popen([sys.executable, '-u', os.path.join(os.path.dirname(LOADTEST_DIR), 'main.py')],
+                                    env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        child = start_child()
+        child_started = time.monotonic()
+        try:
+            # main.py treats whatever is on the page at its first poll as
+            # already seen, so only start publishing once it has fetched it.
+            while not p2000.first_request.wait(1) and child.poll() is None:
+                pass
+            p2000.start_publishing()
+            while time.monotonic() - started < args.duration and child.poll() is None:
+                if args.restart_every and time.monotonic() - child_started >= args.restart_every:
+                    stop_child(child)
+                    child = start_child()
+                    child_started = time.monotonic()
+                    restarts += 1
+                memory.append((round(time.monotonic() - started, 1), rss_kib(child.pid)))
+                next_sample = min(args.memory_interval, max(0, args.duration - (time.monotonic() - started)))
+                if args.restart_every:
+                    next_sample = min(next_sample, max(0, child_started + args.restart_every - time.monotonic()))
+                time.sleep(next_sample)
+        finally:
+            # Stop publishing first, so everything published had a chance to
+            # be polled before main.py flushes its queue and exits.
+            p2000.stop_publishing()
+            time.sleep(args.settle)
+            stop_child(child)
+            p2000.stop()
+            ntfy.stop()
+
+    results = report(p2000, ntfy, [location for location in args.locations.split(',') if location],
+                     outbox, memory, round(time.monotonic() - started, 1))
+    results["restarts"] = restarts
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0 if results["notifications_missed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,9 +1,414 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import time
-from bs4 import BeautifulSoup
+import hashlib
+import re
+import bisect
+import itertools
+import email.utils
+import threading
+import sqlite3
+import json
+import html
+import random
+import asyncio
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
 import signal
 import sys
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from html.entities import html5 as HTML5_ENTITIES
+from html.parser import HTMLParser
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from archive import AlertArchive, iter_alerts, partitions
+import stream
+
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10'))
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '4'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '4'))
+NTFY_WORKERS = int(os.environ.get('NTFY_WORKERS', '2'))
+NTFY_QUEUE_SIZE = int(os.environ.get('NTFY_QUEUE_SIZE', '100'))
+NTFY_SHUTDOWN_TIMEOUT = float(os.environ.get('NTFY_SHUTDOWN_TIMEOUT', '10'))
+NTFY_OUTBOX = os.environ.get('NTFY_OUTBOX', 'ntfy_outbox.sqlite3')
+NTFY_MAX_ATTEMPTS = int(os.environ.get('NTFY_MAX_ATTEMPTS', '10'))
+NTFY_RETRY_BASE = float(os.environ.get('NTFY_RETRY_BASE', '2'))
+NTFY_RETRY_MAX = float(os.environ.get('NTFY_RETRY_MAX', '300'))
+NTFY_COALESCE_WINDOW = float(os.environ.get('NTFY_COALESCE_WINDOW', '0'))
+NTFY_COALESCE_MAX_DELAY = float(os.environ.get('NTFY_COALESCE_MAX_DELAY', '15'))
+# Notifications per second and burst sizes; 0 turns a limit off. The host
+# defaults match the limits ntfy.sh sets itself (60, then one every 5 s).
+# ntfy.sh has no limit per topic, so that one is off unless set, to share
+# the host budget fairly between subscribers.
+NTFY_HOST_RATE = float(os.environ.get('NTFY_HOST_RATE', '0.2'))
+NTFY_HOST_BURST = int(os.environ.get('NTFY_HOST_BURST', '60'))
+NTFY_TOPIC_RATE = float(os.environ.get('NTFY_TOPIC_RATE', '0'))
+NTFY_TOPIC_BURST = int(os.environ.get('NTFY_TOPIC_BURST', '60'))
+P2000_SEEN_STORE = os.environ.get('P2000_SEEN_STORE', 'p2000_seen.sqlite3')
+P2000_SEEN_MAX_AGE = float(os.environ.get('P2000_SEEN_MAX_AGE', '86400'))
+P2000_SEEN_MAX_ENTRIES = int(os.environ.get('P2000_SEEN_MAX_ENTRIES', '1000'))
+P2000_SEEN_BLOOM = os.environ.get('P2000_SEEN_BLOOM', '').lower() in ('1', 'true', 'yes')
+P2000_ARCHIVE_DIR = os.environ.get('P2000_ARCHIVE_DIR', 'archive')
+P2000_ARCHIVE_BATCH = int(os.environ.get('P2000_ARCHIVE_BATCH', '500'))
+P2000_ARCHIVE_FLUSH = float(os.environ.get('P2000_ARCHIVE_FLUSH', '60'))
+P2000_ARCHIVE_INDEX = os.environ.get(
+    'P2000_ARCHIVE_INDEX', os.path.join(P2000_ARCHIVE_DIR, 'index.sqlite3') if P2000_ARCHIVE_DIR else '')
+POLL_INTERVAL = float(os.environ.get('POLL_INTERVAL', '1'))
+POLL_MIN_INTERVAL = float(os.environ.get('POLL_MIN_INTERVAL', '0.5'))
+POLL_MAX_INTERVAL = float(os.environ.get('POLL_MAX_INTERVAL', '5'))
+POLL_ERROR_MAX_INTERVAL = float(os.environ.get('POLL_ERROR_MAX_INTERVAL', '60'))
+POLL_MAX_RATE = float(os.environ.get('POLL_MAX_RATE', '2'))
+METRICS_PORT = os.environ.get('METRICS_PORT')
+P2000_STREAM_PORT = os.environ.get('P2000_STREAM_PORT')
+P2000_STREAM_HISTORY = int(os.environ.get('P2000_STREAM_HISTORY', '100'))
+P2000_STREAM_CLIENT_BUFFER = int(os.environ.get('P2000_STREAM_CLIENT_BUFFER', '1000'))
+P2000_API_INDEX_SIZE = int(os.environ.get('P2000_API_INDEX_SIZE', '5000'))
+P2000_SUBSCRIBERS = os.environ.get('P2000_SUBSCRIBERS')
+P2000_ASYNC = os.environ.get('P2000_ASYNC', '').lower() in ('1', 'true', 'yes')
+P2000_REPLAY = [path for path in os.environ.get('P2000_REPLAY', '').split(',') if path]
+P2000_REPLAY_INTERVAL = float(os.environ.get('P2000_REPLAY_INTERVAL', '0'))
+P2000_REPLAY_VERBOSE = os.environ.get('P2000_REPLAY_VERBOSE', '').lower() in ('1', 'true', 'yes')
+P2000_URL = os.environ.get('P2000_URL', 'http://www.p2000-online.net/p2000.py')
+P2000_URLS = [url.strip() for url in os.environ.get('P2000_URLS', P2000_URL).split(',') if url.strip()]
+P2000_FETCH_WORKERS = int(os.environ.get('P2000_FETCH_WORKERS', '4'))
+P2000_PARSER = os.environ.get('P2000_PARSER')
+NTFY_URL = os.environ.get('NTFY_URL', 'https://ntfy.sh').rstrip('/')
+P2000_TIMEZONE = os.environ.get('P2000_TIMEZONE', 'Europe/Amsterdam')
+P2000_DT_FORMATS = [
+    dt_format for dt_format in (os.environ.get('P2000_DT_FORMAT', '').split('|')
+                                + ['%d-%m-%y %H:%M:%S', '%d-%m-%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%d-%m-%y %H:%M'])
+    if dt_format
+]
+
+_session = None
+_stop_requested = False
+_waiting = False
+_page_pool = None
+
+def parse_pool_sizes(value):
+    """Parses 'prefix=size,prefix=size' into a dict of per-host pool sizes."""
+    pool_sizes = {}
+    for entry in (value or '').split(','):
+        prefix, _, size = entry.strip().rpartition('=')
+        if prefix and size.isdigit():
+            pool_sizes[prefix] = int(size)
+    return pool_sizes
+
+def create_session(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, pool_sizes=None):
+    """Creates a requests session with pooled keep-alive connections.
+
+    `pool_sizes` maps a URL prefix (e.g. 'https://ntfy.sh') to the number of
+    connections kept open for that host, overriding `pool_maxsize`.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    for prefix, size in (pool_sizes or {}).items():
+        session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=size))
+
+    return session
+
+def get_session():
+    """Returns the shared HTTP session, creating it on first use."""
+    global _session
+    if _session is None:
+        _session = create_session(pool_sizes=parse_pool_sizes(os.environ.get('HTTP_POOL_SIZES')))
+    return _session
+
+class Metrics:
+    """Thread-safe counters and histograms, rendered in the Prometheus text format.
+
+    Values that other objects already keep (queue depth, dispatcher totals)
+    are read at render time through collectors instead of being counted twice.
+    """
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text, buckets=None):
+        """Registers the type and help text of a metric."""
+        self._help[name] = (kind, help_text)
+        if kind == 'histogram':
+            self._buckets[name] = tuple(buckets or self.DEFAULT_BUCKETS)
+
+    def add_collector(self, collector):
+        """Adds a callable returning (name, labels, value) samples at render time."""
+        self._collectors.append(collector)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets.get(name, self.DEFAULT_BUCKETS)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observes how long the block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), (counts, total, count) in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets.get(name, self.DEFAULT_BUCKETS), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+
+        output = []
+        for name in sorted(samples):
+            kind, help_text = self._help.get(name, ('untyped', ''))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+METRICS = Metrics()
+METRICS.describe('p2000_stage_seconds', 'histogram', 'Time spent per pipeline stage.')
+METRICS.describe('p2000_polls_total', 'counter', 'Number of page fetches.')
+METRICS.describe('p2000_polls_unchanged_total', 'counter', 'Polls skipped because the page was unchanged.')
+METRICS.describe('p2000_fetch_errors_total', 'counter', 'Page fetches that failed.')
+METRICS.describe('p2000_http_responses_total', 'counter', 'HTTP responses by host and status code.')
+METRICS.describe('p2000_new_alerts_total', 'counter', 'New alerts seen.')
+METRICS.describe('p2000_matches_total', 'counter', 'New alerts that matched a location.')
+METRICS.describe('p2000_subscriber_matches_total', 'counter', 'New alerts routed to a subscriber, by topic.')
+METRICS.describe('p2000_notifications_enqueued_total', 'counter', 'Notifications put on the send queue.')
+METRICS.describe('p2000_notifications_sent_total', 'counter', 'Notifications accepted by ntfy.')
+METRICS.describe('p2000_notifications_failed_total', 'counter', 'Notification attempts that failed.')
+METRICS.describe('p2000_notifications_dropped_total', 'counter', 'Notifications dropped because the queue was full.')
+METRICS.describe('p2000_notifications_retried_total', 'counter', 'Notifications requeued from the outbox.')
+METRICS.describe('p2000_notifications_dead_lettered_total', 'counter', 'Notifications given up on.')
+METRICS.describe('p2000_notification_queue_depth', 'gauge', 'Notifications waiting in the send queue.')
+METRICS.describe('p2000_notifications_throttled_total', 'counter', 'Notifications ntfy refused with 429 Too Many Requests.')
+METRICS.describe('p2000_notifications_delayed_total', 'counter', 'Notifications held back by a rate limit, by limit.')
+METRICS.describe('p2000_notification_delay_seconds', 'histogram', 'Time notifications were held back by a rate limit.',
+                 buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600))
+METRICS.describe('p2000_notifications_coalesced_total', 'counter', 'Alerts sent as part of another alert\'s notification.')
+METRICS.describe('p2000_coalesce_groups', 'gauge', 'Groups of related alerts waiting to be sent.')
+METRICS.describe('p2000_outbox_pending', 'gauge', 'Notifications waiting in the outbox.')
+METRICS.describe('p2000_seen_entries', 'gauge', 'Alert identifiers held for deduplication.')
+METRICS.describe('p2000_seen_memory_bytes', 'gauge', 'Estimated memory held by the deduplication set.')
+METRICS.describe('p2000_seen_evictions_total', 'counter', 'Alert identifiers evicted, by reason.')
+METRICS.describe('p2000_seen_bloom_negatives_total', 'counter', 'Lookups answered by the Bloom filter alone.')
+METRICS.describe('p2000_archive_written_total', 'counter', 'Alerts written to the archive.')
+METRICS.describe('p2000_archive_dropped_total', 'counter', 'Alerts that could not be archived.')
+METRICS.describe('p2000_archive_bytes_total', 'counter', 'Compressed bytes written to the archive.')
+METRICS.describe('p2000_archive_indexed_total', 'counter', 'Archived alerts added to the search index.')
+METRICS.describe('p2000_archive_queue_depth', 'gauge', 'Alerts waiting to be archived.')
+METRICS.describe('p2000_stream_clients', 'gauge', 'Connected stream clients, by protocol.')
+METRICS.describe('p2000_stream_published_total', 'counter', 'Alerts published to the stream.')
+METRICS.describe('p2000_stream_dropped_clients_total', 'counter', 'Stream clients disconnected for falling behind.')
+METRICS.describe('p2000_api_indexed_alerts', 'gauge', 'Recent alerts held for /alerts queries.')
+METRICS.describe('p2000_api_requests_total', 'counter', '/alerts requests, by cache result.')
+METRICS.describe('p2000_poll_interval_seconds', 'gauge', 'Current polling interval.')
+METRICS.describe('p2000_poll_drift_seconds', 'gauge', 'How late the last poll started.')
+METRICS.describe('p2000_alert_latency_seconds', 'histogram',
+                 'Time from the alert timestamp on the page to each pipeline step.',
+                 buckets=(1, 2, 3, 5, 10, 15, 20, 30, 45, 60, 120, 300, 600))
+METRICS.describe('p2000_alert_latency_quantile_seconds', 'gauge', 'Recent alert latency percentiles.')
+
+def get_timezone():
+    """Returns the timezone of the page timestamps, or None to use local time."""
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(P2000_TIMEZONE)
+    except Exception:
+        print(f"--> Timezone '{P2000_TIMEZONE}' is not available, using local time for alert timestamps.")
+        return None
+
+_timezone = get_timezone()
+
+def parse_alert_time(value):
+    """Converts the DT cell of an alert to a Unix timestamp, or None if it cannot be parsed."""
+    for dt_format in P2000_DT_FORMATS:
+        try:
+            published = datetime.strptime(value, dt_format)
+        except ValueError:
+            continue
+        if _timezone is not None:
+            published = published.replace(tzinfo=_timezone)
+        return published.timestamp()
+    return None
+
+class AlertLatency:
+    """Measures how long after its page timestamp an alert reaches each pipeline step.
+
+    The steps are 'seen' (found on the page), 'matched' (location matched)
+    and 'acked' (ntfy accepted the notification). Every sample goes into the
+    p2000_alert_latency_seconds histogram, and the most recent `window`
+    samples per step are kept for percentiles.
+    """
+
+    STAGES = ('seen', 'matched', 'acked')
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._samples = {stage: deque(maxlen=window) for stage in self.STAGES}
+
+    def record(self, alert, stage, at=None):
+        """Records when `alert` reached `stage` and returns the latency in seconds."""
+        at = time.time() if at is None else at
+        alert[f"{stage}_at"] = at
+        published = alert.get('published_at')
+        if published is None:
+            return None
+        # The page only has second resolution and clocks can drift, so a
+        # negative latency is reported as zero.
+        latency = max(0.0, at - published)
+        with self._lock:
+            self._samples[stage].append(latency)
+        METRICS.observe('p2000_alert_latency_seconds', latency, stage=stage)
+        return latency
+
+    def percentiles(self, stage):
+        """Returns {quantile: seconds} over the recent samples of `stage`."""
+        with self._lock:
+            samples = sorted(self._samples[stage])
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in self.QUANTILES}
+
+    def summary(self, alert):
+        """Returns a one line description of the latencies of `alert`."""
+        published = alert.get('published_at')
+        if published is None:
+            return "alert timestamp could not be parsed"
+        steps = [
+            f"{stage} {max(0.0, alert[f'{stage}_at'] - published):.1f}s"
+            for stage in self.STAGES if f"{stage}_at" in alert
+        ]
+        recent = self.percentiles('acked')
+        if recent:
+            steps.append("recent acked " + ", ".join(f"p{int(q * 100)} {value:.1f}s" for q, value in recent.items()))
+        return ", ".join(steps)
+
+    def collect(self):
+        """Returns the latency percentile samples."""
+        return [
+            ('p2000_alert_latency_quantile_seconds', {'stage': stage, 'quantile': q}, value)
+            for stage in self.STAGES
+            for q, value in self.percentiles(stage).items()
+        ]
+
+ALERT_LATENCY = AlertLatency()
+METRICS.add_collector(ALERT_LATENCY.collect)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves METRICS on /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    """Serves the metrics endpoint on a background thread."""
+    server = ThreadingHTTPServer(('', int(port)), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+STARTUP_NOTIFICATION = (
+    "The P2000 Alerter script has been updated, update log in Github will be updated ASAP",
+    {
+        "Title": "P2000 Alerter: Service Restarted",
+        "Priority": "high",
+        "Tags": "rocket",
+        "Click": "https://github.com/lalutir/P2000-Reader/releases"
+    })
+SHUTDOWN_NOTIFICATION = (
+    "The P2000 Alerter script is paused for maintenance.",
+    {
+        "Title": "P2000 Alerter: Service Shutting Down",
+        "Priority": "high",
+        "Tags": "information_source"
+    })
+
+def alert_notification(alert):
+    """Returns the ntfy body and headers for an alert, or for a group of them from AlertCoalescer."""
+    messages = [alert['message']] + [related['message'] for related in alert.get('related', ())]
+    message_body = (
+        "\n".join(messages) + "\n\n"
+        "Klik op de melding om naar p2000-online.net te gaan"
+    )
+    title = f"Nieuwe Melding: {alert['service']}"
+    if len(messages) > 1:
+        title += f" ({len(messages)} meldingen)"
+    return message_body.encode('utf-8'), {
+        "Title": title,
+        "Priority": "high",
+        "Tags": "police_car" if alert['service'] == "Politie" else "fire_engine" if alert['service'] == "Brandweer" else "ambulance",
+        "Click": "https://www.p2000-online.net/alleregiosf.html"
+    }
 
 def send_startup_notification(ntfy_topic):
     """Sends a startup notification using ntfy."""
@@ -12,15 +417,8 @@ def send_startup_notification(ntfy_topic):
     
     try:
         print("--> Sending startup notification...")
-        requests.post(
-            f"https://ntfy.sh/{ntfy_topic}",
-            data="The P2000 Alerter script has been updated, update log in Github will be updated ASAP",
-            headers={
-                "Title": "P2000 Alerter: Service Restarted",
-                "Priority": "high",
-                "Tags": "rocket",
-                "Click": "https://github.com/lalutir/P2000-Reader/releases"
-            })
+        data, headers = STARTUP_NOTIFICATION
+        get_session().post(f"{NTFY_URL}/{ntfy_topic}", data=data, headers=headers, timeout=HTTP_TIMEOUT)
         print("--> Startup notification sent!")
     except Exception as e:
         print(f"--> Failed to send startup notification: {e}")
@@ -33,169 +431,1970 @@ def send_shutdown_notification(ntfy_topic):
     
     try:
         print("--> Sending shutdown notification...")
-        requests.post(
-            f"https://ntfy.sh/{ntfy_topic}",
-            data="The P2000 Alerter script is paused for maintenance.",
-            headers={
-                "Title": "P2000 Alerter: Service Shutting Down",
-                "Priority": "high",
-                "Tags": "information_source"
-            })
+        data, headers = SHUTDOWN_NOTIFICATION
+        get_session().post(f"{NTFY_URL}/{ntfy_topic}", data=data, headers=headers, timeout=HTTP_TIMEOUT)
         print("--> Shutdown notification sent!")
     except Exception as e:
         print(f"--> Failed to send shutdown notification: {e}")
 
+class ShutdownRequested(Exception):
+    """Raised by shutdown_handler() to cut the wait between polls short."""
+
 def shutdown_handler(signum, frame):
-    """Handles graceful shutdown."""
-    print("\nShutdown signal received. Exiting gracefully...")
-    ntfy_topic = os.environ.get('NTFY_TOPIC')
-    send_shutdown_notification(ntfy_topic)
-    sys.exit(0)
+    """Asks the refresh loop to stop; main() shuts down after the current poll.
+
+    The shutdown itself does not run here: the signal can arrive while the
+    main thread holds the dispatcher's or the outbox's locks. Only the wait
+    between polls, which holds none, is interrupted.
+    """
+    global _stop_requested
+    _stop_requested = True
+    if _waiting:
+        raise ShutdownRequested()
+
+class Throttled(requests.exceptions.HTTPError):
+    """A 429 Too Many Requests response; `retry_after` is the wait it asked for in seconds, or None."""
+
+    def __init__(self, url, retry_after=None):
+        super().__init__(f"429 Too Many Requests for url: {url}")
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    """Returns the seconds to wait from a Retry-After header (seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, moment.timestamp() - time.time())
 
 def send_notification(alert, ntfy_topic):
-    """Sends a notification using ntfy."""
+    """Sends a notification using ntfy.
+
+    Returns whether ntfy accepted it, and raises Throttled when ntfy asks to
+    slow down, so the dispatcher can hold the notification back.
+    """
     if not ntfy_topic:
         print("NTFY_TOPIC environment variable not set. Skipping notification.")
-        return
-        
-    message_body = (
-        f"{alert['message']}\n\n"
-        "Klik op de melding om naar p2000-online.net te gaan"
-    )
+        return False
         
+    data, headers = alert_notification(alert)
     try:
-        requests.post(
-            f"https://ntfy.sh/{ntfy_topic}",
-            data=message_body.encode('utf-8'),
-            headers={
-                "Title": f"Nieuwe Melding: {alert['service']}",
-                "Priority": "high",
-                "Tags": "police_car" if alert['service'] == "Politie" else "fire_engine" if alert['service'] == "Brandweer" else "ambulance",
-                "Click": "https://www.p2000-online.net/alleregiosf.html"
-            })
+        response = get_session().post(f"{NTFY_URL}/{ntfy_topic}", data=data, headers=headers, timeout=HTTP_TIMEOUT)
+        METRICS.inc('p2000_http_responses_total', host=urlsplit(response.url).hostname, code=response.status_code)
+        if response.status_code == 429:
+            raise Throttled(response.url, parse_retry_after(response.headers.get('Retry-After')))
+        response.raise_for_status()
+        print("--> Notification sent!")
+        return True
+    except Throttled:
+        raise
+    except Exception as e:
+        print(f"--> Failed to send notification: {e}")
+        return False
+
+def retry_delay(attempts, base=NTFY_RETRY_BASE, maximum=NTFY_RETRY_MAX):
+    """Returns the jittered exponential backoff delay after `attempts` failed attempts."""
+    delay = min(maximum, base * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class NotificationOutbox:
+    """Keeps pending notifications in SQLite until ntfy has accepted them.
+
+    Failed entries are rescheduled with retry_delay() and moved to the dead
+    letters after `max_attempts` failures. The file survives restarts, so
+    notifications that were pending when the process stopped are sent after
+    it starts again.
+    """
+
+    def __init__(self, path, max_attempts=NTFY_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " topic TEXT NOT NULL,"
+            " alert TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt REAL NOT NULL,"
+            " last_error TEXT,"
+            " dead INTEGER NOT NULL DEFAULT 0)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, next_attempt)")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def add(self, alert, ntfy_topic):
+        """Stores a new notification and returns its id."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (topic, alert, created, next_attempt) VALUES (?, ?, ?, ?)",
+                (ntfy_topic, json.dumps(alert), now, now))
+            return cursor.lastrowid
+
+    def due(self, limit, exclude=()):
+        """Returns up to `limit` entries that are due for a (re)try, skipping the ids in `exclude`."""
+        rows = self._execute(
+            "SELECT id, alert, topic FROM outbox WHERE dead = 0 AND next_attempt <= ?"
+            " ORDER BY next_attempt, id LIMIT ?",
+            (time.time(), limit + len(exclude)))
+        return [
+            (entry_id, json.loads(alert), topic)
+            for entry_id, alert, topic in rows if entry_id not in exclude
+        ][:limit]
+
+    def delivered(self, entry_id):
+        """Removes an entry that ntfy has accepted."""
+        self._execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def failed(self, entry_id, error):
+        """Reschedules a failed entry, or dead-letters it after too many attempts.
+
+        Returns True if the entry was dead-lettered.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT attempts FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                return False
+            attempts = row[0] + 1
+            dead = attempts >= self.max_attempts
+            self._conn.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ?, dead = ?"
+                " WHERE id = ?",
+                (attempts, time.time() + retry_delay(attempts), error, int(dead), entry_id))
+        return dead
+
+    def pending_count(self):
+        """Returns the number of notifications that still have to be delivered."""
+        return self._execute("SELECT COUNT(*) FROM outbox WHERE dead = 0")[0][0]
+
+    def dead_letters(self):
+        """Returns the notifications that were given up on, oldest first."""
+        rows = self._execute("SELECT id, topic, alert, attempts, last_error FROM outbox WHERE dead = 1 ORDER BY id")
+        return [
+            {"id": entry_id, "topic": topic, "alert": json.loads(alert), "attempts": attempts, "last_error": last_error}
+            for entry_id, topic, alert, attempts, last_error in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def incident_key(alert):
+    """Returns what identifies the incident of an alert: its region and the last two words without digits.
+
+    Those are usually the street and place, while priorities, unit codes and
+    ride numbers change between the messages about one incident.
+    """
+    words = [word for word in alert['message'].lower().split() if not any(char.isdigit() for char in word)]
+    return alert['region'], tuple(words[-2:])
+
+class AlertCoalescer:
+    """Groups related alerts for a topic so they can be sent as one notification.
+
+    An alert opens a group for its incident_key() and topic. Related alerts
+    join it until none came for `window` seconds, and a group is due at the
+    latest `max_delay` seconds after its first alert. Holds no threads or
+    locks; the dispatcher decides when to ask for the due groups.
+    """
+
+    def __init__(self, window, max_delay):
+        self.window = window
+        self.max_delay = max_delay
+        self._groups = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._groups)
+
+    def add(self, alert, ntfy_topic, now):
+        key = (ntfy_topic, incident_key(alert))
+        group = self._groups.get(key)
+        if group is None:
+            self._groups[key] = group = {"alerts": [], "topic": ntfy_topic, "first": now}
+        group["alerts"].append(alert)
+        group["due"] = min(group["first"] + self.max_delay, now + self.window)
+
+    def wait_time(self, now):
+        """Returns the seconds until the next group is due, or None without groups."""
+        if not self._groups:
+            return None
+        return min(group["due"] for group in self._groups.values()) - now
+
+    def pop_due(self, now=None):
+        """Removes the groups that are due (all of them if `now` is None); returns (alert, topic) to send."""
+        due = [key for key, group in self._groups.items() if now is None or group["due"] <= now]
+        return [self._combine(self._groups.pop(key)) for key in due]
+
+    def _combine(self, group):
+        first, *related = group["alerts"]
+        self.coalesced += len(related)
+        if not related:
+            return first, group["topic"]
+        return dict(first, related=[{"service": alert['service'], "message": alert['message']}
+                                    for alert in related]), group["topic"]
+
+ALERT_PRIORITY_RE = re.compile(r'(?:PRIO|P|A)\s*([0-9])\b', re.IGNORECASE)
+
+def alert_priority(alert):
+    """Returns how urgent an alert is, from 1 (most urgent) up, for ordering its notification.
+
+    Messages start with their priority: "P 1" or "Prio 2" for the fire
+    brigade and police, "A1" or "A2" for ambulances. Planned ambulance rides
+    ("B") and messages without a priority come after those. A group from
+    AlertCoalescer is as urgent as its most urgent alert.
+    """
+    priorities = []
+    for message in [alert['message']] + [related['message'] for related in alert.get('related', ())]:
+        match = ALERT_PRIORITY_RE.match(message.lstrip())
+        if match:
+            priorities.append(int(match.group(1)))
+        else:
+            priorities.append(4 if message.lstrip()[:1].upper() == 'B' else 3)
+    return min(priorities)
+
+class TokenBucket:
+    """Allows `rate` events per second on average, in bursts of up to `burst`; a rate of 0 allows all."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = now
+        self.paused_until = now
+
+    def wait_time(self, now):
+        """Returns the seconds until a token is available, 0 if one is."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.rate <= 0:
+            return 0
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Uses a token; call after wait_time() returned 0."""
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def pause(self, seconds, now):
+        """Holds every token back for `seconds`, after which one is available and the rest refill from empty."""
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 1
+        self.updated = self.paused_until
+
+class NotificationScheduler:
+    """Orders waiting notifications by alert_priority() and releases them as the ntfy rate limits allow.
+
+    There is a TokenBucket for the ntfy server and one per topic. The next
+    notification is the most urgent one whose topic has a token left, as
+    soon as the server has one, so urgent alerts go first when the budget
+    is short and, with a topic limit set, a busy topic cannot hold up the
+    others. Holds no locks; the dispatcher calls it with its own held.
+    """
+
+    def __init__(self, maxsize, host_rate=NTFY_HOST_RATE, host_burst=NTFY_HOST_BURST,
+                 topic_rate=NTFY_TOPIC_RATE, topic_burst=NTFY_TOPIC_BURST):
+        self.maxsize = maxsize
+        self.topic_rate = topic_rate
+        self.topic_burst = topic_burst
+        self.host = TokenBucket(host_rate, host_burst, time.monotonic())
+        self._topics = {}
+        # (priority, sequence, queued at, item), kept sorted.
+        self._waiting = []
+        self._sequence = itertools.count()
+        # Limit that first held back each waiting notification, by sequence.
+        self._held = {}
+        self.delayed = {'host': 0, 'topic': 0}
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def push(self, item, now):
+        """Adds an (entry id, alert, topic) item; returns False if there is no room."""
+        if len(self._waiting) >= self.maxsize:
+            return False
+        bisect.insort(self._waiting, (alert_priority(item[1]), next(self._sequence), now, item))
+        return True
+
+    def _topic(self, ntfy_topic, now):
+        bucket = self._topics.get(ntfy_topic)
+        if bucket is None:
+            bucket = self._topics[ntfy_topic] = TokenBucket(self.topic_rate, self.topic_burst, now)
+        return bucket
+
+    def pop(self, now):
+        """Returns (item, 0) for the notification to send now, or (None, seconds until one may be sent).
+
+        The seconds are None when nothing is waiting.
+        """
+        if not self._waiting:
+            return None, None
+        wait = self.host.wait_time(now)
+        if wait > 0:
+            for _, sequence, _, _ in self._waiting:
+                self._held.setdefault(sequence, 'host')
+            return None, wait
+        for position, (_, sequence, queued_at, item) in enumerate(self._waiting):
+            bucket = self._topic(item[2], now)
+            topic_wait = bucket.wait_time(now)
+            if topic_wait > 0:
+                self._held.setdefault(sequence, 'topic')
+                wait = topic_wait if not wait else min(wait, topic_wait)
+                continue
+            del self._waiting[position]
+            self.host.take()
+            bucket.take()
+            limit = self._held.pop(sequence, None)
+            if limit is not None:
+                self.delayed[limit] += 1
+                METRICS.observe('p2000_notification_delay_seconds', now - queued_at)
+            return item, 0
+        return None, wait
+
+    def throttle(self, retry_after, now):
+        """Pauses sending after a 429 response, for `retry_after` seconds or one host token; returns the pause."""
+        if retry_after is None:
+            retry_after = max(NTFY_RETRY_BASE, 1 / self.host.rate if self.host.rate > 0 else 0)
+        self.host.pause(retry_after, now)
+        return retry_after
+
+    def collect(self):
+        return [('p2000_notifications_delayed_total', {'limit': limit}, count)
+                for limit, count in self.delayed.items()]
+
+class NotificationDispatcher:
+    """Sends notifications from a bounded queue on a small pool of worker threads.
+
+    The queue is a NotificationScheduler: most urgent alerts first, within
+    the ntfy rate limits. With an outbox, notifications are stored before
+    they are queued and failed sends are retried; without one, notifications
+    that do not fit in the queue are dropped. With a `coalesce_window`,
+    related alerts are grouped into one notification first.
+    """
+
+    def __init__(self, workers=NTFY_WORKERS, max_queue=NTFY_QUEUE_SIZE, outbox=None,
+                 coalesce_window=NTFY_COALESCE_WINDOW, coalesce_max_delay=NTFY_COALESCE_MAX_DELAY):
+        self.outbox = outbox
+        self._coalescer = AlertCoalescer(coalesce_window, coalesce_max_delay) if coalesce_window > 0 else None
+        self._coalesce_ready = threading.Condition()
+        self._coalescing = self._coalescer is not None
+        self._scheduler = NotificationScheduler(max_queue)
+        self._ready = threading.Condition()
+        self._stopping = False
+        self._workers = [
+            threading.Thread(target=self._run, name=f"ntfy-sender-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        self._retrier = threading.Thread(target=self._retry_loop, name="ntfy-retry", daemon=True)
+        self._grouper = threading.Thread(target=self._coalesce_loop, name="ntfy-coalesce", daemon=True)
+        self._lock = threading.Lock()
+        self._inflight = set()
+        self._closed = False
+        self._stopped = threading.Event()
+        self.enqueued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.throttled = 0
+        self.max_depth = 0
+
+    def start(self):
+        """Starts the sender workers and, with an outbox, the retry scheduler."""
+        for worker in self._workers:
+            worker.start()
+        if self.outbox is not None:
+            self._retrier.start()
+        if self._coalescer is not None:
+            self._grouper.start()
+        return self
+
+    def depth(self):
+        """Returns the number of notifications waiting to be sent."""
+        return len(self._scheduler)
+
+    def submit(self, alert, ntfy_topic):
+        """Queues a notification, or holds it for its group; returns False if it was dropped."""
+        with self._coalesce_ready:
+            if self._coalescing:
+                self._coalescer.add(alert, ntfy_topic, time.monotonic())
+                self._wake_coalescer()
+                return True
+        return self._submit(alert, ntfy_topic)
+
+    def _submit(self, alert, ntfy_topic):
+        if self._closed:
+            if self.outbox is not None:
+                self.outbox.add(alert, ntfy_topic)
+                print("--> Notifications are shut down, notification will be sent from the outbox on the next run.")
+                return True
+            with self._lock:
+                self.dropped += 1
+            print(f"--> Notifications are shut down, dropped notification ({self.dropped} dropped so far).")
+            return False
+        entry_id = None
+        if self.outbox is not None:
+            # Stored and marked in flight in one step, so the retry scheduler
+            # cannot pick the new entry up as well.
+            with self._lock:
+                entry_id = self.outbox.add(alert, ntfy_topic)
+                self._inflight.add(entry_id)
+        if not self._enqueue((entry_id, alert, ntfy_topic)):
+            if entry_id is not None:
+                with self._lock:
+                    self._inflight.discard(entry_id)
+                print("--> Notification queue is full, notification will be sent from the outbox.")
+                return True
+            with self._lock:
+                self.dropped += 1
+            print(f"--> Notification queue is full, dropped notification ({self.dropped} dropped so far).")
+            return False
+
+        with self._lock:
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self.depth())
+        return True
+
+    def _enqueue(self, item):
+        """Hands an (entry id, alert, topic) item to the senders, returning False if there is no room."""
+        with self._ready:
+            if not self._scheduler.push(item, time.monotonic()):
+                return False
+            self._ready.notify()
+        return True
+
+    def _free_slots(self):
+        return self._scheduler.maxsize - len(self._scheduler)
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while True:
+                    item, wait = self._scheduler.pop(time.monotonic())
+                    if item is not None:
+                        break
+                    if self._stopping and not len(self._scheduler):
+                        return
+                    self._ready.wait(wait)
+            entry_id, alert, ntfy_topic = item
+            try:
+                with METRICS.time('p2000_stage_seconds', stage='notify'):
+                    delivered = send_notification(alert, ntfy_topic)
+            except Throttled as e:
+                self._throttle(item, e.retry_after)
+                continue
+            self._finish(entry_id, alert, delivered)
+
+    def _throttle(self, item, retry_after):
+        """Pauses sending after ntfy answered 429 and queues the notification again."""
+        with self._ready:
+            pause = self._scheduler.throttle(retry_after, time.monotonic())
+        with self._lock:
+            self.throttled += 1
+        print(f"--> ntfy is rate limiting, pausing notifications for {pause:.1f} s.")
+        if not self._enqueue(item):
+            # No room: it counts as a failed attempt and, with an outbox, is retried from there.
+            self._finish(item[0], item[1], False)
+
+    def _finish(self, entry_id, alert, delivered):
+        """Updates the counters and the outbox after a delivery attempt."""
+        if delivered:
+            ALERT_LATENCY.record(alert, 'acked')
+            print(f"--> Latency since publication: {ALERT_LATENCY.summary(alert)}")
+            with self._lock:
+                self.sent += 1
+            if entry_id is not None:
+                self.outbox.delivered(entry_id)
+        else:
+            with self._lock:
+                self.failed += 1
+            if entry_id is not None and self.outbox.failed(entry_id, "ntfy delivery failed"):
+                with self._lock:
+                    self.dead_lettered += 1
+                print(f"--> Giving up on notification {entry_id}, moved to dead letters.")
+        if entry_id is not None:
+            with self._lock:
+                self._inflight.discard(entry_id)
+
+    def _retry_loop(self):
+        while not self._stopped.wait(1):
+            self._retry_due()
+
+    def _wake_coalescer(self):
+        """Called with _coalesce_ready held after a group changed."""
+        self._coalesce_ready.notify()
+
+    def _coalesce_loop(self):
+        while True:
+            with self._coalesce_ready:
+                while True:
+                    if not self._coalescing:
+                        return
+                    wait = self._coalescer.wait_time(time.monotonic())
+                    if wait is not None and wait <= 0:
+                        break
+                    self._coalesce_ready.wait(wait)
+                due = self._coalescer.pop_due(time.monotonic())
+            for alert, ntfy_topic in due:
+                self._submit(alert, ntfy_topic)
+
+    def _flush_groups(self):
+        """Stops coalescing and queues every group that is still held."""
+        with self._coalesce_ready:
+            self._coalescing = False
+            groups = self._coalescer.pop_due() if self._coalescer is not None else []
+            self._wake_coalescer()
+        # Groups the grouper thread already took are queued before it stops.
+        if self._grouper.is_alive():
+            self._grouper.join()
+        if groups:
+            print(f"--> Sending {len(groups)} held group(s) of alerts...")
+        for alert, ntfy_topic in groups:
+            self._submit(alert, ntfy_topic)
+
+    def _retry_due(self):
+        """Requeues the outbox entries that are due for a retry, as far as there is room."""
+        free = self._free_slots()
+        if free <= 0:
+            return
+        with self._lock:
+            due = self.outbox.due(free, exclude=self._inflight)
+            self._inflight.update(entry_id for entry_id, _, _ in due)
+        for position, (entry_id, alert, ntfy_topic) in enumerate(due):
+            if not self._enqueue((entry_id, alert, ntfy_topic)):
+                with self._lock:
+                    self._inflight.difference_update(entry_id for entry_id, _, _ in due[position:])
+                break
+            with self._lock:
+                self.retried += 1
+
+    def collect(self):
+        """Returns the dispatcher's metric samples."""
+        samples = [
+            ('p2000_notifications_enqueued_total', {}, self.enqueued),
+            ('p2000_notifications_sent_total', {}, self.sent),
+            ('p2000_notifications_failed_total', {}, self.failed),
+            ('p2000_notifications_dropped_total', {}, self.dropped),
+            ('p2000_notifications_retried_total', {}, self.retried),
+            ('p2000_notifications_dead_lettered_total', {}, self.dead_lettered),
+            ('p2000_notifications_throttled_total', {}, self.throttled),
+            ('p2000_notification_queue_depth', {}, self.depth()),
+        ] + self._scheduler.collect()
+        if self._coalescer is not None:
+            samples.append(('p2000_notifications_coalesced_total', {}, self._coalescer.coalesced))
+            samples.append(('p2000_coalesce_groups', {}, len(self._coalescer)))
+        if self.outbox is not None:
+            samples.append(('p2000_outbox_pending', {}, self.outbox.pending_count()))
+        return samples
+
+    def shutdown(self, timeout=None):
+        """Stops accepting notifications, sends the queued ones and stops the workers."""
+        self._flush_groups()
+        self._closed = True
+        self._stopped.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - time.monotonic())
+
+        print(f"--> Flushing {self.depth()} queued notification(s)...")
+        # Workers stop once the queue is empty, still keeping to the rate limits.
+        with self._ready:
+            self._stopping = True
+            self._ready.notify_all()
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join(remaining())
+        self._print_summary(self.depth())
+
+    def _print_summary(self, unsent):
+        print(f"--> Notifications: {self.sent} sent, {self.failed} failed, {self.throttled} throttled, "
+              f"{self.dropped} dropped, {unsent} left unsent.")
+        if self.outbox is not None:
+            print(f"--> {self.outbox.pending_count()} notification(s) left in the outbox for the next run.")
+
+class AsyncHTTPClient:
+    """Makes HTTP requests from asyncio code.
+
+    Uses aiohttp when it is installed. Otherwise the pooled requests session
+    is used from worker threads, so requests still overlap.
+    """
+
+    def __init__(self):
+        self._session = None
+        if aiohttp is not None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=max(HTTP_POOL_MAXSIZE, NTFY_WORKERS)),
+                timeout=aiohttp.ClientTimeout(connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT))
+
+    async def request(self, method, url, data=None, headers=None):
+        """Returns the status code, headers and body of a request.
+
+        Error responses raise requests' HTTPError, as raise_for_status() does,
+        and 429 responses its Throttled subclass.
+        """
+        if self._session is None:
+            response = await asyncio.to_thread(
+                get_session().request, method, url, data=data, headers=headers, timeout=HTTP_TIMEOUT)
+            status, response_headers, body = response.status_code, response.headers, response.content
+        else:
+            async with self._session.request(method, url, data=data, headers=headers) as response:
+                status, response_headers, body = response.status, response.headers, await response.read()
+        METRICS.inc('p2000_http_responses_total', host=urlsplit(url).hostname, code=status)
+        if status == 429:
+            raise Throttled(url, parse_retry_after(response_headers.get('Retry-After')))
+        if status >= 400:
+            raise requests.exceptions.HTTPError(f"{status} Error for url: {url}")
+        return status, response_headers, body
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+ASYNC_HTTP_ERRORS = (requests.exceptions.RequestException, asyncio.TimeoutError) + (
+    (aiohttp.ClientError,) if aiohttp is not None else ())
+
+async def send_startup_notification_async(client, ntfy_topic):
+    """Like send_startup_notification(), with the async HTTP client."""
+    if not ntfy_topic:
+        return
+    try:
+        print("--> Sending startup notification...")
+        data, headers = STARTUP_NOTIFICATION
+        await client.request('POST', f"{NTFY_URL}/{ntfy_topic}", data=data, headers=headers)
+        print("--> Startup notification sent!")
+    except Exception as e:
+        print(f"--> Failed to send startup notification: {e}")
+
+async def send_shutdown_notification_async(client, ntfy_topic):
+    """Like send_shutdown_notification(), with the async HTTP client."""
+    if not ntfy_topic:
+        print("NTFY_TOPIC not set. Skipping shutdown notification.")
+        return
+    try:
+        print("--> Sending shutdown notification...")
+        data, headers = SHUTDOWN_NOTIFICATION
+        await client.request('POST', f"{NTFY_URL}/{ntfy_topic}", data=data, headers=headers)
+        print("--> Shutdown notification sent!")
+    except Exception as e:
+        print(f"--> Failed to send shutdown notification: {e}")
+
+async def send_notification_async(client, alert, ntfy_topic):
+    """Like send_notification(), with the async HTTP client."""
+    data, headers = alert_notification(alert)
+    try:
+        await client.request('POST', f"{NTFY_URL}/{ntfy_topic}", data=data, headers=headers)
         print("--> Notification sent!")
+        return True
+    except Throttled:
+        raise
     except Exception as e:
         print(f"--> Failed to send notification: {e}")
+        return False
+
+class AsyncNotificationDispatcher(NotificationDispatcher):
+    """Sends notifications as asyncio tasks, at most `workers` at the same time.
+
+    Outbox, retries, rate limits and counters work as in
+    NotificationDispatcher; a task takes the next notification from the
+    scheduler whenever a slot is free. Must be created and used on the
+    event loop.
+    """
+
+    def __init__(self, client, workers=NTFY_WORKERS, max_queue=NTFY_QUEUE_SIZE, outbox=None,
+                 coalesce_window=NTFY_COALESCE_WINDOW, coalesce_max_delay=NTFY_COALESCE_MAX_DELAY):
+        super().__init__(workers=0, max_queue=max_queue, outbox=outbox,
+                         coalesce_window=coalesce_window, coalesce_max_delay=coalesce_max_delay)
+        self.client = client
+        self.workers = workers
+        self._tasks = set()
+        self._queue_changed = asyncio.Event()
+        self._sender_task = None
+        self._retry_task = None
+        self._coalesce_task = None
+        self._coalesce_changed = asyncio.Event()
+
+    def start(self):
+        self._sender_task = asyncio.ensure_future(self._send_loop())
+        if self.outbox is not None:
+            self._retry_task = asyncio.ensure_future(self._retry_loop())
+        if self._coalescer is not None:
+            self._coalesce_task = asyncio.ensure_future(self._coalesce_loop())
+        return self
+
+    def _enqueue(self, item):
+        if not self._scheduler.push(item, time.monotonic()):
+            return False
+        self._queue_changed.set()
+        return True
+
+    async def _send_loop(self):
+        while True:
+            wait = None
+            while len(self._tasks) < self.workers:
+                item, wait = self._scheduler.pop(time.monotonic())
+                if item is None:
+                    break
+                task = asyncio.ensure_future(self._send(*item))
+                self._tasks.add(task)
+                task.add_done_callback(self._sent)
+            else:
+                # Every slot is taken; wait for a send to finish.
+                wait = None
+            if self._stopping and not self._tasks and not len(self._scheduler):
+                return
+            self._queue_changed.clear()
+            try:
+                await asyncio.wait_for(self._queue_changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _sent(self, task):
+        self._tasks.discard(task)
+        self._queue_changed.set()
+
+    async def _send(self, entry_id, alert, ntfy_topic):
+        try:
+            with METRICS.time('p2000_stage_seconds', stage='notify'):
+                delivered = await send_notification_async(self.client, alert, ntfy_topic)
+        except Throttled as e:
+            self._throttle((entry_id, alert, ntfy_topic), e.retry_after)
+            return
+        self._finish(entry_id, alert, delivered)
+
+    async def _retry_loop(self):
+        while not self._closed:
+            await asyncio.sleep(1)
+            self._retry_due()
+
+    def _wake_coalescer(self):
+        self._coalesce_changed.set()
+
+    async def _coalesce_loop(self):
+        while self._coalescing:
+            wait = self._coalescer.wait_time(time.monotonic())
+            if wait is None or wait > 0:
+                self._coalesce_changed.clear()
+                try:
+                    await asyncio.wait_for(self._coalesce_changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for alert, ntfy_topic in self._coalescer.pop_due(time.monotonic()):
+                self._submit(alert, ntfy_topic)
+
+    async def shutdown(self, timeout=None):
+        """Stops accepting notifications and waits up to `timeout` seconds for the pending ones."""
+        self._flush_groups()
+        self._closed = True
+        if self._retry_task is not None:
+            self._retry_task.cancel()
+        print(f"--> Flushing {self.depth() + len(self._tasks)} queued notification(s)...")
+        self._stopping = True
+        self._queue_changed.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._sender_task), timeout)
+        except asyncio.TimeoutError:
+            pass
+        unsent = self.depth() + len(self._tasks)
+        # Cancelled notifications stay in the outbox for the next run.
+        self._sender_task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        self._print_summary(unsent)
 
 def clear_screen():
-    """Clears the console screen."""    
+    """Clears the console screen, unless the output goes to a file or a replay."""
+    if not sys.stdout.isatty():
+        return
     if os.name == 'nt':
         os.system('cls')
     else:
         os.system('clear')
 
-def scrape(url):
-    """Scrapes and returns the single latest alert from the given URL."""
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        response.encoding = 'windows-1252'
-        soup = BeautifulSoup(response.text, 'html.parser')
+def alert_key(identifier):
+    """Returns the compact hash that is stored for a (datetime, message) identifier."""
+    datetime_text, message = identifier
+    return hashlib.blake2b(f"{datetime_text}\x00{message}".encode('utf-8'), digest_size=8).digest()
+
+class SeenStore:
+    """Keeps the seen alerts and page watermarks in SQLite across restarts.
+
+    Alerts are stored as alert_key() hashes with the time they were seen.
+    Entries older than `max_age` seconds are expired, and watermarks that
+    old are not loaded, so after a long outage the first poll starts fresh.
+    """
+
+    def __init__(self, path, max_age=P2000_SEEN_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY, seen_at REAL NOT NULL) WITHOUT ROWID")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS seen_age ON seen (seen_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks ("
+            " page TEXT PRIMARY KEY, datetime TEXT NOT NULL, message TEXT NOT NULL, saved_at REAL NOT NULL)")
+        self._expired_at = 0
+        self.expire()
+
+    def expire(self):
+        """Deletes the entries that are older than `max_age`."""
+        now = time.time()
+        cutoff = now - self.max_age
+        with self._conn:
+            self._conn.execute("DELETE FROM seen WHERE seen_at < ?", (cutoff,))
+            self._conn.execute("DELETE FROM watermarks WHERE saved_at < ?", (cutoff,))
+        self._expired_at = now
+
+    def recent(self, limit):
+        """Returns (key, seen_at) of the `limit` most recently seen alerts, oldest first."""
+        rows = self._conn.execute(
+            "SELECT key, seen_at FROM seen WHERE seen_at >= ? ORDER BY seen_at DESC LIMIT ?",
+            (time.time() - self.max_age, limit)).fetchall()
+        return list(reversed(rows))
+
+    def watermarks(self):
+        """Returns {page: identifier} of the watermarks saved within `max_age`."""
+        rows = self._conn.execute(
+            "SELECT page, datetime, message FROM watermarks WHERE saved_at >= ?",
+            (time.time() - self.max_age,)).fetchall()
+        return {page or None: (datetime_text, message) for page, datetime_text, message in rows}
+
+    def save(self, keys, watermarks):
+        """Stores newly seen alert keys and the current watermarks of changed pages."""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO seen (key, seen_at) VALUES (?, ?)", [(key, now) for key in keys])
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO watermarks (page, datetime, message, saved_at) VALUES (?, ?, ?, ?)",
+                [(page or '', identifier[0], identifier[1], now) for page, identifier in watermarks.items()])
+        if now - self._expired_at > 3600:
+            self.expire()
+
+    def close(self):
+        self._conn.close()
+
+class SeenSet:
+    """A bounded set of alert_key() hashes, evicted by age and least recent use.
+
+    With `bloom`, lookups check a Bloom filter of the keys before the dict;
+    it is off by default because a dict lookup is cheaper in CPython.
+    """
+
+    BLOOM_BITS_PER_KEY = 10
+    BLOOM_HASHES = 7
+
+    def __init__(self, max_entries=P2000_SEEN_MAX_ENTRIES, max_age=P2000_SEEN_MAX_AGE, bloom=False):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        # key -> time last seen, least recently seen first.
+        self._entries = OrderedDict()
+        self.evictions = {'age': 0, 'size': 0}
+        self.bloom_negatives = 0
+        self._bloom = None
+        self._bloom_bits = max(64, max_entries * self.BLOOM_BITS_PER_KEY)
+        self._bloom_stale = 0
+        if bloom:
+            self._rebuild_bloom()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        if self._bloom is not None and not self._bloom_has(key):
+            self.bloom_negatives += 1
+            return False
+        return key in self._entries
+
+    def add(self, key, at=None):
+        """Adds a key or marks it as seen again; returns True if it was new."""
+        new = key not in self
+        self._entries[key] = time.time() if at is None else at
+        self._entries.move_to_end(key)
+        if new and self._bloom is not None:
+            for position in self._bloom_positions(key):
+                self._bloom[position >> 3] |= 1 << (position & 7)
+        self.expire()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions['size'] += 1
+            self._bloom_stale += 1
+        # Evicted keys stay in the filter until it is rebuilt.
+        if self._bloom is not None and self._bloom_stale > self.max_entries // 2:
+            self._rebuild_bloom()
+        return new
+
+    def expire(self):
+        """Drops the keys that were last seen more than `max_age` seconds ago."""
+        cutoff = time.time() - self.max_age
+        while self._entries:
+            key, seen_at = next(iter(self._entries.items()))
+            if seen_at >= cutoff:
+                break
+            del self._entries[key]
+            self.evictions['age'] += 1
+            self._bloom_stale += 1
+
+    def _bloom_positions(self, key):
+        # Double hashing on the two halves of the (already random) key.
+        first = int.from_bytes(key[:4], 'little')
+        step = int.from_bytes(key[4:8], 'little') | 1
+        return [(first + i * step) % self._bloom_bits for i in range(self.BLOOM_HASHES)]
+
+    def _bloom_has(self, key):
+        bloom = self._bloom
+        return all(bloom[position >> 3] & (1 << (position & 7)) for position in self._bloom_positions(key))
+
+    def _rebuild_bloom(self):
+        self._bloom = bytearray((self._bloom_bits + 7) // 8)
+        for key in self._entries:
+            for position in self._bloom_positions(key):
+                self._bloom[position >> 3] |= 1 << (position & 7)
+        self._bloom_stale = 0
+
+    def memory_bytes(self):
+        """Returns an estimate of the memory held by the set, in bytes."""
+        size = sys.getsizeof(self._entries)
+        if self._entries:
+            key, seen_at = next(iter(self._entries.items()))
+            size += len(self._entries) * (sys.getsizeof(key) + sys.getsizeof(seen_at))
+        if self._bloom is not None:
+            size += sys.getsizeof(self._bloom)
+        return size
+
+    def collect(self):
+        """Returns the set's metric samples."""
+        samples = [
+            ('p2000_seen_entries', {}, len(self._entries)),
+            ('p2000_seen_memory_bytes', {}, self.memory_bytes()),
+        ]
+        samples.extend(('p2000_seen_evictions_total', {'reason': reason}, count)
+                       for reason, count in self.evictions.items())
+        if self._bloom is not None:
+            samples.append(('p2000_seen_bloom_negatives_total', {}, self.bloom_negatives))
+        return samples
+
+class AlertDeltaTracker:
+    """Tracks which alerts have been seen and returns the ones that are new.
+
+    Every page has its own watermark, but the seen alerts are shared, so an
+    alert that shows up on several pages is only returned once. With a
+    SeenStore the state survives restarts: it is loaded at start and the
+    changes are written by save().
+    """
+
+    def __init__(self, max_seen=P2000_SEEN_MAX_ENTRIES, store=None, bloom=P2000_SEEN_BLOOM):
+        self.watermarks = {}
+        self.store = store
+        self.seen = SeenSet(max_seen, bloom=bloom)
+        self._unsaved = []
+        self._changed_pages = set()
+        if store is not None:
+            self.watermarks.update(store.watermarks())
+            for key, seen_at in store.recent(max_seen):
+                self.seen.add(key, seen_at)
+
+    def __len__(self):
+        return len(self.seen)
+
+    def _remember(self, identifier):
+        """Marks an alert as seen; returns True if it was not seen before."""
+        key = alert_key(identifier)
+        if not self.seen.add(key):
+            return False
+        if self.store is not None:
+            self._unsaved.append(key)
+        return True
+
+    def save(self):
+        """Writes the alerts seen and watermarks moved since the last save to the store."""
+        if self.store is None or not (self._unsaved or self._changed_pages):
+            return
+        self.store.save(self._unsaved, {page: self.watermarks[page] for page in self._changed_pages})
+        self._unsaved = []
+        self._changed_pages.clear()
+
+    def new_alerts(self, alerts, page=None, seen=None):
+        """Returns the alerts newer than the watermark of `page`, oldest first.
+
+        `alerts` is the newest-first list returned by scrape(). On the very
+        first poll of a page only the top alert is returned, so a restart
+        does not replay the whole page. All alerts that had not been seen
+        before, including the ones not returned, are appended to `seen`
+        (oldest first).
+        """
+        if not alerts:
+            return []
+
+        if self.watermarks.get(page) is None:
+            unseen = [alert for alert in alerts if self._remember((alert['datetime'], alert['message']))]
+            fresh = unseen[:1] if unseen and unseen[0] is alerts[0] else []
+        else:
+            unseen = []
+            for alert in alerts:
+                identifier = (alert['datetime'], alert['message'])
+                if identifier == self.watermarks[page]:
+                    break
+                if self._remember(identifier):
+                    unseen.append(alert)
+            fresh = unseen
+        if seen is not None:
+            seen.extend(reversed(unseen))
+
+        top = alerts[0]
+        watermark = (top['datetime'], top['message'])
+        if self.watermarks.get(page) != watermark:
+            self.watermarks[page] = watermark
+            self._changed_pages.add(page)
+        return list(reversed(fresh))
+
+class PageState:
+    """Remembers the validators and body hash of the last page fetched from a URL."""
+
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+        self.polls = 0
+        self.short_circuited = 0
+
+    def request_headers(self):
+        """Returns the conditional request headers for the next fetch."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def unchanged(self):
+        self.short_circuited += 1
+        METRICS.inc('p2000_polls_unchanged_total')
+        return None
+
+    def changed(self, headers, content):
+        """Stores the validators of a 200 response and returns its body, or None if the body is unchanged."""
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+
+        body_hash = hashlib.blake2b(content, digest_size=16).digest()
+        if body_hash == self.body_hash:
+            return self.unchanged()
+        self.body_hash = body_hash
+        return content
+
+_page_states = {}
+
+def fetch_page(url):
+    """Fetches the raw page body, or returns None if it is unchanged since the last poll."""
+    state = _page_states.setdefault(url, PageState())
+    state.polls += 1
+
+    METRICS.inc('p2000_polls_total')
+    with METRICS.time('p2000_stage_seconds', stage='fetch'):
+        response = get_session().get(url, headers=state.request_headers(), timeout=HTTP_TIMEOUT)
+    METRICS.inc('p2000_http_responses_total', host=urlsplit(url).hostname, code=response.status_code)
+    if response.status_code == 304:
+        return state.unchanged()
+    response.raise_for_status()
+    return state.changed(response.headers, response.content)
+
+ALERT_FIELDS = (
+    ('datetime', frozenset(['DT'])),
+    ('service', frozenset(['Am', 'Br', 'Po'])),
+    ('region', frozenset(['Regio'])),
+    ('message', frozenset(['Md', 'Mdx'])),
+)
+# Cells with the capcodes an alert was paged to. They are in the alert's
+# row and in the rows below it, up to the next alert; with nested rows a
+# cell only counts for its nearest row.
+CAPCODE_CLASS = 'Oms'
+SERVICE_CLASSES = {'Ambulance': 'Am', 'Brandweer': 'Br', 'Politie': 'Po'}
+
+PAGE_HEADER = '<html><head><title>P2000 Alle Regios</title></head><body><table style="width:100%">\n'
+PAGE_FOOTER = '\n</table></body></html>\n'
 
+def render_alert(alert):
+    """Returns the table rows of an alert in the markup of the alert page."""
+    rows = [
+        f'<tr><td class="DT">{html.escape(alert["datetime"])}</td>'
+        f'<td class="{SERVICE_CLASSES.get(alert["service"], "Am")}">{html.escape(alert["service"])}</td>'
+        f'<td class="Regio">{html.escape(alert["region"])}</td>'
+        f'<td class="Md">{html.escape(alert["message"])}</td></tr>'
+    ]
+    for capcode in alert.get('capcodes') or ():
+        rows.append(f'<tr><td></td><td></td><td></td><td class="{CAPCODE_CLASS}">{html.escape(capcode)}</td></tr>')
+    return '\n'.join(rows)
+
+def render_page(alerts):
+    """Returns alerts (newest first) as an alert page, for replays and the fake server."""
+    return PAGE_HEADER + '\n'.join(render_alert(alert) for alert in alerts) + PAGE_FOOTER
+
+def parse_alerts_soup(text, stop_at=None):
+    """Parses the alert table by building the full BeautifulSoup tree (reference backend)."""
+    soup = BeautifulSoup(text, 'html.parser')
+
+    all_alerts_raw = []
+    for row in soup.find_all('tr'):
+        dt_cell = row.find('td', class_='DT')
+        service_cell = row.find('td', class_=['Am', 'Br', 'Po'])
+        region_cell = row.find('td', class_='Regio')
+        message_cell = row.find('td', class_=['Md', 'Mdx'])
+        capcodes = [
+            cell.text.strip() for cell in row.find_all('td', class_=CAPCODE_CLASS)
+            if cell.text.strip() and cell.find_parent('tr') is row
+        ]
+
+        if dt_cell and service_cell and region_cell and message_cell:
+            if (dt_cell.text.strip(), message_cell.text.strip()) == stop_at:
+                break
+            all_alerts_raw.append({
+                "datetime": dt_cell.text.strip(),
+                "service": service_cell.text.strip(),
+                "region": region_cell.text.strip(),
+                "message": message_cell.text.strip(),
+                "capcodes": capcodes,
+            })
+        elif all_alerts_raw:
+            all_alerts_raw[-1]['capcodes'].extend(capcodes)
+    return all_alerts_raw
+
+class StopParsing(Exception):
+    """Raised by AlertTableParser once it reaches the alert it was told to stop at."""
+
+class AlertTableParser(HTMLParser):
+    """Streaming tokenizer that only collects the text of the alert table cells.
+
+    Follows the tree building rules of BeautifulSoup's html.parser builder,
+    so it produces the same alerts as parse_alerts_soup().
+    """
+
+    VOID_ELEMENTS = frozenset([
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link',
+        'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound',
+        'command', 'frame', 'image', 'isindex', 'nextid', 'spacer',
+    ])
+    STRING_CONTAINERS = frozenset(['rt', 'rp', 'style', 'script', 'template'])
+    PRESERVE_WHITESPACE = frozenset(['pre', 'textarea'])
+    ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+    def __init__(self, stop_at=None):
+        super().__init__(convert_charrefs=False)
+        self.stop_at = stop_at
+        self.rows = []
+        self._stack = []
+        self._open_counts = {}
+        self._open_rows = []
+        self._open_cells = []
+        self._containers = 0
+        self._preserve = 0
+        self._data = []
+        self._already_closed = []
+        self._stop_after = None
+
+    def _flush(self, cdata=False):
+        if not self._data:
+            return
+        data = ''.join(self._data)
+        self._data = []
+        if not self._open_cells or (self._containers and not cdata):
+            return
+        if not self._preserve and not data.strip(self.ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        for cell in self._open_cells:
+            cell.append(data)
+
+    def _push(self, tag, attrs):
+        self._flush()
+        item = None
+        if tag == 'tr':
+            item = {}
+            self.rows.append(item)
+            self._open_rows.append(item)
+        elif tag == 'td' and self._open_rows:
+            classes = set()
+            for key, value in attrs:
+                if key == 'class':
+                    classes = set((value or '').split())
+            for row in self._open_rows:
+                for field, names in ALERT_FIELDS:
+                    if field not in row and not classes.isdisjoint(names):
+                        if item is None:
+                            item = []
+                            self._open_cells.append(item)
+                        row[field] = item
+            if CAPCODE_CLASS in classes:
+                if item is None:
+                    item = []
+                    self._open_cells.append(item)
+                # Unlike the alert fields, a capcode belongs to its nearest row only.
+                self._open_rows[-1].setdefault('capcodes', []).append(item)
+        elif tag in self.STRING_CONTAINERS:
+            self._containers += 1
+        elif tag in self.PRESERVE_WHITESPACE:
+            self._preserve += 1
+        self._stack.append((tag, item))
+        self._open_counts[tag] = self._open_counts.get(tag, 0) + 1
+
+    def _pop_to(self, tag):
+        self._flush()
+        if not self._open_counts.get(tag):
+            return
+        while True:
+            name, item = self._stack.pop()
+            self._open_counts[name] -= 1
+            if name == 'tr':
+                self._row_closed(self._open_rows.pop())
+            elif item is not None:
+                self._open_cells.pop()
+            elif name in self.STRING_CONTAINERS:
+                self._containers -= 1
+            elif name in self.PRESERVE_WHITESPACE:
+                self._preserve -= 1
+            if name == tag:
+                break
+
+    @staticmethod
+    def _complete(row):
+        return len(row) - ('capcodes' in row) == len(ALERT_FIELDS)
+
+    def _row_closed(self, row):
+        if row is self._stop_after:
+            raise StopParsing()
+        if self.stop_at is None or self._stop_after is not None or not self._complete(row):
+            return
+        identifier = (''.join(row['datetime']).strip(), ''.join(row['message']).strip())
+        if identifier != self.stop_at:
+            return
+
+        # Everything after this row is already known. Rows still open around
+        # it (a missing </tr> nests the next rows inside them) are newer
+        # alerts that can still get cells, text and capcodes, so parsing goes
+        # on until the outermost of them is closed too.
+        if not self._open_rows:
+            raise StopParsing()
+        self._stop_after = self._open_rows[0]
+
+    def handle_starttag(self, tag, attrs):
+        self._push(tag, attrs)
+        if tag in self.VOID_ELEMENTS:
+            self._pop_to(tag)
+            self._already_closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._push(tag, attrs)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._already_closed:
+            self._already_closed.remove(tag)
+        else:
+            self._pop_to(tag)
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_charref(self, name):
+        if name[:1] in ('x', 'X'):
+            codepoint = int(name.lstrip('xX'), 16)
+        else:
+            codepoint = int(name)
+        data = None
+        if codepoint < 256:
+            try:
+                data = bytes([codepoint]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(codepoint)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or '\N{REPLACEMENT CHARACTER}')
+
+    def handle_entityref(self, name):
+        self.handle_data(HTML5_ENTITIES.get(name + ';', '&' + name))
+
+    def handle_comment(self, data):
+        self._flush()
+
+    def handle_decl(self, decl):
+        self._flush()
+
+    def handle_pi(self, data):
+        self._flush()
+
+    def unknown_decl(self, data):
+        self._flush()
+        if data.upper().startswith('CDATA['):
+            self._data.append(data[len('CDATA['):])
+            self._flush(cdata=True)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+    def alerts(self):
+        """Returns the alert dicts of all complete rows, in document order."""
         all_alerts_raw = []
-        main_alert_rows = soup.find_all(lambda tag: tag.name == 'tr' and tag.find('td', class_='DT'))
-
-        for row in main_alert_rows:
-            dt_cell = row.find('td', class_='DT')
-            service_cell = row.find('td', class_=['Am', 'Br', 'Po'])
-            region_cell = row.find('td', class_='Regio')
-            message_cell = row.find('td', class_=['Md', 'Mdx'])
-
-            if dt_cell and service_cell and region_cell and message_cell:
-                all_alerts_raw.append({
-                    "datetime": dt_cell.text.strip(),
-                    "service": service_cell.text.strip(),
-                    "region": region_cell.text.strip(),
-                    "message": message_cell.text.strip(),
-                })
-
-        unique_alerts = []
-        seen_alerts = set()
-        for alert in all_alerts_raw:
-            identifier = (alert['datetime'], alert['message'])
-            if identifier not in seen_alerts:
-                unique_alerts.append(alert)
-                seen_alerts.add(identifier)
-
-        return unique_alerts[0] if unique_alerts else None
+        for row in self.rows:
+            capcodes = [text for text in (''.join(cell).strip() for cell in row.get('capcodes', ())) if text]
+            if self._complete(row):
+                alert = {field: ''.join(row[field]).strip() for field, _ in ALERT_FIELDS}
+                if (alert['datetime'], alert['message']) == self.stop_at:
+                    break
+                alert['capcodes'] = capcodes
+                all_alerts_raw.append(alert)
+            elif all_alerts_raw:
+                all_alerts_raw[-1]['capcodes'].extend(capcodes)
+        return all_alerts_raw
+
+def parse_alerts_stream(text, stop_at=None):
+    """Parses the alert table with the streaming AlertTableParser.
+
+    If `stop_at` is a (datetime, message) identifier, tokenizing stops at the
+    row with that identifier, or once the rows left open around it are
+    closed, and only the rows above it are returned.
+    """
+    parser = AlertTableParser(stop_at)
+    try:
+        parser.feed(text)
+        parser.close()
+    except StopParsing:
+        pass
+    return parser.alerts()
+
+# Parser backends, fastest first.
+PARSER_BACKENDS = {
+    'stream': parse_alerts_stream,
+    'soup': parse_alerts_soup,
+}
+
+def available_parsers():
+    """Returns the names of the parser backends that can run in this environment."""
+    return [name for name in PARSER_BACKENDS if name == 'stream' or BeautifulSoup is not None]
 
+def select_parser(name=None):
+    """Returns the requested parser backend, or the fastest available one."""
+    available = available_parsers()
+    if name and name in available:
+        return PARSER_BACKENDS[name]
+    if name:
+        print(f"--> Parser '{name}' is not available, using '{available[0]}' instead.")
+    return PARSER_BACKENDS[available[0]]
+
+def dedupe_alerts(all_alerts_raw):
+    """Removes repeated (datetime, message) alerts, keeping the first occurrence."""
+    unique_alerts = []
+    seen_alerts = set()
+    for alert in all_alerts_raw:
+        identifier = (alert['datetime'], alert['message'])
+        if identifier not in seen_alerts:
+            unique_alerts.append(alert)
+            seen_alerts.add(identifier)
+    return unique_alerts
+
+def parse_page(content, parser=None, stop_at=None):
+    """Decodes, parses and dedupes a fetched page body; None (unchanged) gives no alerts."""
+    if content is None:
+        return []
+
+    parse = parser or select_parser(P2000_PARSER)
+    with METRICS.time('p2000_stage_seconds', stage='decode'):
+        text = content.decode('windows-1252', errors='replace')
+    with METRICS.time('p2000_stage_seconds', stage='parse'):
+        all_alerts_raw = parse(text, stop_at=stop_at)
+    with METRICS.time('p2000_stage_seconds', stage='dedup'):
+        return dedupe_alerts(all_alerts_raw)
+
+def scrape(url, parser=None, stop_at=None):
+    """Scrapes and returns all unique alerts from the given URL, newest first.
+
+    When `stop_at` is the identifier of the last alert already processed,
+    parsing stops there and only the alerts above it are returned.
+    """
+    try:
+        return parse_page(fetch_page(url), parser, stop_at)
     except requests.exceptions.RequestException as e:
+        METRICS.inc('p2000_fetch_errors_total')
+        print(f"\nAn error occurred while trying to fetch the website: {e}")
+        return None
+
+def scrape_pages(urls, tracker, parser=None):
+    """Scrapes several pages at the same time; returns {url: scrape() result}."""
+    global _page_pool
+    if len(urls) == 1:
+        return {urls[0]: scrape(urls[0], parser, tracker.watermarks.get(urls[0]))}
+
+    if _page_pool is None:
+        _page_pool = ThreadPoolExecutor(max_workers=P2000_FETCH_WORKERS, thread_name_prefix="p2000-fetch")
+    futures = {url: _page_pool.submit(scrape, url, parser, tracker.watermarks.get(url)) for url in urls}
+    return {url: future.result() for url, future in futures.items()}
+
+async def fetch_page_async(client, url):
+    """Like fetch_page(), with the async HTTP client."""
+    state = _page_states.setdefault(url, PageState())
+    state.polls += 1
+
+    METRICS.inc('p2000_polls_total')
+    with METRICS.time('p2000_stage_seconds', stage='fetch'):
+        status, headers, content = await client.request('GET', url, headers=state.request_headers())
+    if status == 304:
+        return state.unchanged()
+    return state.changed(headers, content)
+
+async def scrape_async(client, url, parser=None, stop_at=None):
+    """Like scrape(), with the async HTTP client."""
+    try:
+        return parse_page(await fetch_page_async(client, url), parser, stop_at)
+    except ASYNC_HTTP_ERRORS as e:
+        METRICS.inc('p2000_fetch_errors_total')
         print(f"\nAn error occurred while trying to fetch the website: {e}")
         return None
 
+async def scrape_pages_async(client, urls, tracker, parser=None):
+    """Like scrape_pages(), with the async HTTP client."""
+    results = await asyncio.gather(*(
+        scrape_async(client, url, parser, tracker.watermarks.get(url)) for url in urls))
+    return dict(zip(urls, results))
+
+DEFAULT_LOCATIONS = ('ZOETMR', 'zoetermeer', 'BLEISW', 'bleiswijk', 'DELFT')
+
+def load_locations():
+    """Returns the location keywords from P2000_LOCATIONS / P2000_LOCATIONS_FILE, or the defaults."""
+    locations_file = os.environ.get('P2000_LOCATIONS_FILE')
+    if locations_file:
+        with open(locations_file, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+    locations = os.environ.get('P2000_LOCATIONS')
+    if locations:
+        return [location.strip() for location in locations.split(',') if location.strip()]
+
+    return list(DEFAULT_LOCATIONS)
+
+class LocationMatcher:
+    """Finds location keywords in an alert's fields with one compiled regex.
+
+    The keywords are lowercased and folded into a trie shaped pattern, so the
+    cost of scanning a field barely depends on how many keywords there are.
+    """
+
+    def __init__(self, keywords, fields=('service', 'message')):
+        self.fields = fields
+        self.keywords = {}
+        for keyword in keywords:
+            self.keywords.setdefault(keyword.lower(), keyword)
+
+        # At any position the regex only reports the longest keyword, so the
+        # keywords that are a prefix of it are looked up here.
+        self._prefixes = {
+            keyword: [prefix for prefix in (keyword[:end] for end in range(1, len(keyword) + 1)) if prefix in self.keywords]
+            for keyword in self.keywords
+        }
+
+        self._pattern = None
+        if self.keywords:
+            # The lookahead lets keywords that overlap (e.g. 'meer' inside
+            # 'zoetermeer') all be reported.
+            self._pattern = re.compile('(?=(' + self._trie_pattern(self.keywords) + '))')
+
+    @classmethod
+    def _trie_pattern(cls, words):
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        return cls._node_pattern(trie)
+
+    @classmethod
+    def _node_pattern(cls, node):
+        branches = [re.escape(char) + cls._node_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        pattern = '(?:' + '|'.join(branches) + ')'
+        return pattern + '?' if '' in node else pattern
+
+    def match(self, alert):
+        """Returns the keywords found in the alert's fields, in keyword list order."""
+        if self._pattern is None:
+            return []
+
+        found = set()
+        for field in self.fields:
+            for match in self._pattern.finditer(alert[field].lower()):
+                found.update(self._prefixes[match.group(1)])
+        return [keyword for normalized, keyword in self.keywords.items() if normalized in found]
+
+def load_subscribers(ntfy_topic=None):
+    """Returns the subscriber table from the P2000_SUBSCRIBERS JSON file.
+
+    Without P2000_SUBSCRIBERS there is a single subscriber: `ntfy_topic` with
+    the locations from load_locations().
+    """
+    if not P2000_SUBSCRIBERS:
+        return [{"topic": ntfy_topic, "keywords": load_locations()}]
+
+    with open(P2000_SUBSCRIBERS, encoding='utf-8') as f:
+        subscribers = json.load(f)
+    if isinstance(subscribers, dict):
+        subscribers = subscribers.get('subscribers', [])
+    for subscriber in subscribers:
+        if not subscriber.get('topic'):
+            raise ValueError(f"Subscriber without a topic in {P2000_SUBSCRIBERS}: {subscriber}")
+        for key in ('keywords', 'services', 'regions'):
+            values = subscriber.get(key)
+            # A string would be taken as a list of single letters.
+            if values is not None and (not isinstance(values, list)
+                                       or not all(isinstance(value, str) for value in values)):
+                raise ValueError(f"Subscriber {key} must be a list of strings in {P2000_SUBSCRIBERS}: {subscriber}")
+    return subscribers
+
+class SubscriberIndex:
+    """Routes alerts to the subscribers whose rules they match.
+
+    Each subscriber is a dict with a `topic` and optional `keywords`,
+    `services` and `regions` lists. An alert matches when it contains one of
+    the keywords (or the subscriber has none) and its service and region are
+    in the lists that are given. The keywords of all subscribers share one
+    LocationMatcher, and an inverted index from keyword to subscribers means
+    only the subscribers of the keywords that were found are looked at.
+    """
+
+    def __init__(self, subscribers, fields=('service', 'message')):
+        self.subscribers = [
+            {
+                "topic": subscriber.get('topic'),
+                "keywords": list(subscriber.get('keywords') or []),
+                "services": {service.lower() for service in subscriber.get('services') or []},
+                "regions": {region.lower() for region in subscriber.get('regions') or []},
+            }
+            for subscriber in subscribers
+        ]
+        self.by_keyword = {}
+        self.unkeyed = []
+        for position, subscriber in enumerate(self.subscribers):
+            if not subscriber['keywords']:
+                self.unkeyed.append(position)
+            for keyword in subscriber['keywords']:
+                positions = self.by_keyword.setdefault(keyword.lower(), [])
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+        self.matcher = LocationMatcher([keyword for subscriber in self.subscribers for keyword in subscriber['keywords']],
+                                       fields)
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def route(self, alert):
+        """Returns (subscriber, matched keywords) for every subscriber the alert matches."""
+        found = {keyword.lower() for keyword in self.matcher.match(alert)}
+        candidates = set(self.unkeyed)
+        for keyword in found:
+            candidates.update(self.by_keyword[keyword])
+        if not candidates:
+            return []
+
+        service = alert['service'].lower()
+        region = alert['region'].lower()
+        routes = []
+        for position in sorted(candidates):
+            subscriber = self.subscribers[position]
+            if subscriber['services'] and service not in subscriber['services']:
+                continue
+            if subscriber['regions'] and region not in subscriber['regions']:
+                continue
+            keywords = [keyword for keyword in subscriber['keywords'] if keyword.lower() in found]
+            routes.append((subscriber, keywords))
+        return routes
+
+class PollScheduler:
+    """Decides when to poll next, adapting the interval to the alert traffic.
+
+    New alerts drop the interval to `min_interval`. Every poll without new
+    alerts stretches it by `idle_factor`, up to `max_interval`, so quiet
+    periods are polled less often. Failed polls back off exponentially up to
+    `error_max_interval`. The interval never goes below 1 / `max_rate`, with
+    `max_rate` in polls per second.
+
+    Polls are scheduled from the start of the previous poll, so the time
+    spent scraping is not added to the interval. How late each poll starts
+    compared to its planned time is kept as drift.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL, min_interval=POLL_MIN_INTERVAL,
+                 max_interval=POLL_MAX_INTERVAL, error_max_interval=POLL_ERROR_MAX_INTERVAL,
+                 max_rate=POLL_MAX_RATE, idle_factor=1.2):
+        self.floor = 1 / max_rate if max_rate > 0 else 0
+        self.base_interval = max(interval, self.floor)
+        self.min_interval = max(min_interval, self.floor)
+        self.max_interval = max(max_interval, self.base_interval)
+        self.error_max_interval = max(error_max_interval, self.base_interval)
+        self.idle_factor = idle_factor
+        self.interval = self.base_interval
+        self.errors = 0
+        self.polls = 0
+        self.overruns = 0
+        self.last_drift = 0.0
+        self.max_drift = 0.0
+        self._started = None
+        self._planned = None
+
+    def due_in(self):
+        """Returns the seconds until the next poll is due, or None before the first poll."""
+        return None if self._planned is None else self._planned - time.monotonic()
+
+    def wait(self):
+        """Sleeps until the next poll is due."""
+        remaining = self.due_in()
+        if remaining is not None and remaining > 0:
+            time.sleep(remaining)
+        self.begin(remaining)
+
+    def begin(self, remaining):
+        """Records the start of a poll that was due in `remaining` seconds when waiting began."""
+        now = time.monotonic()
+        if self._planned is not None:
+            if remaining <= 0:
+                self.overruns += 1
+            self.last_drift = max(0.0, now - self._planned)
+            self.max_drift = max(self.max_drift, self.last_drift)
+        self._started = now
+        self.polls += 1
+
+    def collect(self):
+        """Returns the scheduler's metric samples."""
+        return [
+            ('p2000_poll_interval_seconds', {}, self.interval),
+            ('p2000_poll_drift_seconds', {}, self.last_drift),
+        ]
+
+    def record(self, new_alerts=0, error=False):
+        """Updates the interval after a poll and plans the next one."""
+        if error:
+            self.errors += 1
+            self.interval = min(self.error_max_interval, self.base_interval * 2 ** self.errors)
+        else:
+            if self.errors:
+                self.interval = self.base_interval
+            self.errors = 0
+            if new_alerts:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.max_interval, max(self.interval, self.base_interval) * self.idle_factor)
+        self._planned = self._started + self.interval
+        return self.interval
+
+def handle_alert(alert, subscribers, dispatcher):
+    """Prints a new alert and sends a notification to every subscriber it matches."""
+    print(f"--- New Alert ---")
+    print(f"Time:    {alert['datetime']}")
+    print(f"Service: {alert['service']}")
+    print(f"Region:  {alert['region']}")
+    print(f"Message: {alert['message']}")
+    print("--------------------")
+
+    with METRICS.time('p2000_stage_seconds', stage='match'):
+        routes = subscribers.route(alert)
+    if not routes:
+        print("--> Service does not match locations, skipping notification.")
+        return
+
+    METRICS.inc('p2000_matches_total')
+    ALERT_LATENCY.record(alert, 'matched')
+    for subscriber, matched in routes:
+        ntfy_topic = subscriber['topic']
+        rule = f"locations ({', '.join(matched)})" if matched else "its rules"
+        if not ntfy_topic:
+            print(f"--> Service matches any of {rule}, but NTFY_TOPIC is not set. Skipping notification.")
+            continue
+        METRICS.inc('p2000_subscriber_matches_total', topic=ntfy_topic)
+        print(f"--> Service matches any of {rule} for {ntfy_topic}, queueing notification...")
+        dispatcher.submit(alert, ntfy_topic)
+
+def open_outbox():
+    """Opens the notification outbox, or returns None if NTFY_OUTBOX is empty."""
+    if not NTFY_OUTBOX:
+        return None
+    outbox = NotificationOutbox(NTFY_OUTBOX)
+    pending = outbox.pending_count()
+    if pending:
+        print(f"--- Resending {pending} notification(s) left in the outbox ---")
+    return outbox
+
+def start_stream():
+    """Starts the live alert stream on P2000_STREAM_PORT, or returns None if it is not set or cannot run."""
+    if not P2000_STREAM_PORT:
+        return None
+    if stream.tornado is None:
+        print("--> P2000_STREAM_PORT is set but Tornado is not installed, not streaming alerts.")
+        return None
+    try:
+        alert_stream = stream.AlertStream(int(P2000_STREAM_PORT), history=P2000_STREAM_HISTORY,
+                                          client_buffer=P2000_STREAM_CLIENT_BUFFER,
+                                          index_size=P2000_API_INDEX_SIZE, timezone=_timezone).start()
+    except OSError as e:
+        print(f"--> Could not serve the alert stream on port {P2000_STREAM_PORT}: {e}")
+        return None
+    METRICS.add_collector(alert_stream.collect)
+    print(f"--- Streaming alerts on port {P2000_STREAM_PORT} at /stream (SSE), /ws, /recent and /alerts ---")
+    return alert_stream
+
+def create_pipeline(urls, ntfy_topic, dispatcher):
+    """Creates the subscribers, tracker, scheduler, archive and alert stream, and starts the metrics server."""
+    subscribers = SubscriberIndex(load_subscribers(ntfy_topic))
+    if P2000_SUBSCRIBERS:
+        print(f"--- Routing alerts to {len(subscribers)} subscriber(s) from {P2000_SUBSCRIBERS} ---")
+    store = None
+    if P2000_SEEN_STORE:
+        store = SeenStore(P2000_SEEN_STORE)
+    # A page shows about a hundred alerts, and all pages share the seen set.
+    tracker = AlertDeltaTracker(max_seen=max(P2000_SEEN_MAX_ENTRIES, 200 * len(urls)), store=store)
+    if store is not None and tracker.watermarks:
+        print(f"--- Resuming from {len(tracker)} seen alert(s) in {P2000_SEEN_STORE} ---")
+    # Every poll fetches all pages, and POLL_MAX_RATE caps the requests.
+    scheduler = PollScheduler(max_rate=POLL_MAX_RATE / max(1, len(urls)))
+    archive = None
+    if P2000_ARCHIVE_DIR:
+        archive = AlertArchive(P2000_ARCHIVE_DIR, _timezone, batch_size=P2000_ARCHIVE_BATCH,
+                               flush_interval=P2000_ARCHIVE_FLUSH, index_path=P2000_ARCHIVE_INDEX or None).start()
+        METRICS.add_collector(archive.collect)
+        print(f"--- Archiving alerts to {P2000_ARCHIVE_DIR} ---")
+    METRICS.add_collector(dispatcher.collect)
+    METRICS.add_collector(scheduler.collect)
+    METRICS.add_collector(tracker.seen.collect)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+        print(f"--- Metrics are served on port {METRICS_PORT} at /metrics ---")
+    return subscribers, tracker, scheduler, archive, start_stream()
+
+def process_alerts(pages, tracker, subscribers, dispatcher, archive=None, alert_stream=None):
+    """Handles the new alerts of the scraped pages and returns how many there were.
+
+    `pages` maps each URL to what scrape() returned for it. The new alerts of
+    all pages are merged into one deduplicated stream, oldest first. Every
+    alert not seen before goes to the archive, also the ones that are not
+    announced (like the rest of the page on the first poll).
+    """
+    with METRICS.time('p2000_stage_seconds', stage='delta'):
+        new_alerts = []
+        unseen = []
+        for url, alerts in pages.items():
+            new_alerts.extend(tracker.new_alerts(alerts, page=url, seen=unseen))
+    METRICS.inc('p2000_new_alerts_total', len(new_alerts))
+    if new_alerts:
+        clear_screen()
+
+    seen_at = time.time()
+    for alert in unseen:
+        alert['published_at'] = parse_alert_time(alert['datetime'])
+        if archive is not None:
+            archive.add(alert, seen_at)
+    for alert in new_alerts:
+        ALERT_LATENCY.record(alert, 'seen', seen_at)
+    if len(pages) > 1:
+        new_alerts.sort(key=lambda alert: alert['published_at'] or 0)
+
+    for alert in new_alerts:
+        if alert_stream is not None:
+            alert_stream.publish(alert)
+        handle_alert(alert, subscribers, dispatcher)
+    # Saved after the notifications are in the outbox, so a crash in
+    # between repeats alerts rather than losing them.
+    tracker.save()
+    return len(new_alerts)
+
+REPLAY_PAGE_SIZE = 100
+
+class ReplayDispatcher:
+    """Counts the notifications a replay would send instead of sending them."""
+
+    def __init__(self):
+        self.sent = {}
+
+    def submit(self, alert, ntfy_topic):
+        self.sent[ntfy_topic] = self.sent.get(ntfy_topic, 0) + 1
+        return True
+
+def read_replay_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def replay_pages(paths, interval=P2000_REPLAY_INTERVAL):
+    """Yields the page bodies to replay, one per poll, from recorded pages and archive directories.
+
+    A recorded HTML file is one poll, and a directory of them is replayed in
+    name order. Archived alerts are grouped into the polls they were seen in
+    (they share their seen_at), or with an `interval` into one poll per that
+    many seconds of alert time. Every poll shows the latest REPLAY_PAGE_SIZE
+    alerts, newest first, like the real page.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield read_replay_file(path)
+        elif not partitions(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(('.html', '.htm')):
+                    yield read_replay_file(os.path.join(path, name))
+        else:
+            # Rendered once per alert, as an alert stays on the page for many polls.
+            shown = deque(maxlen=REPLAY_PAGE_SIZE)
+            poll = None
+            for alert in iter_alerts(path):
+                if interval:
+                    alert_poll = (alert.get('published_at') or alert['seen_at']) // interval
+                else:
+                    alert_poll = alert['seen_at']
+                if alert_poll != poll and poll is not None:
+                    yield (PAGE_HEADER + '\n'.join(reversed(shown)) + PAGE_FOOTER).encode(
+                        'windows-1252', errors='replace')
+                poll = alert_poll
+                shown.append(render_alert(alert))
+            if poll is not None:
+                yield (PAGE_HEADER + '\n'.join(reversed(shown)) + PAGE_FOOTER).encode('windows-1252', errors='replace')
+
+def replay(paths, ntfy_topic=None):
+    """Runs recorded pages through parsing, delta detection and routing without waiting or sending.
+
+    The seen store, archive and outbox are left alone, and the output of
+    every alert is hidden unless P2000_REPLAY_VERBOSE is set. Returns the
+    ReplayDispatcher with the notifications that would have been sent.
+    """
+    subscribers = SubscriberIndex(load_subscribers(ntfy_topic or 'replay'))
+    tracker = AlertDeltaTracker()
+    dispatcher = ReplayDispatcher()
+    parser = select_parser(P2000_PARSER)
+    polls = page_bytes = new_count = 0
+
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(sys.stdout if P2000_REPLAY_VERBOSE else devnull):
+        for content in replay_pages(paths):
+            polls += 1
+            page_bytes += len(content)
+            alerts = parse_page(content, parser, tracker.watermarks.get(None))
+            new_count += process_alerts({None: alerts}, tracker, subscribers, dispatcher)
+    elapsed = time.perf_counter() - started
+
+    print(f"--- Replayed {polls} page(s) ({page_bytes / 1e6:.1f} MB) in {elapsed:.2f} s: "
+          f"{new_count} new alert(s), {new_count / elapsed if elapsed else 0:.0f} alerts/s, "
+          f"{polls / elapsed if elapsed else 0:.0f} polls/s ---")
+    total = sum(dispatcher.sent.values())
+    by_topic = ', '.join(f"{topic} {count}" for topic, count in sorted(dispatcher.sent.items()))
+    print(f"--- {total} notification(s) would have been sent{': ' + by_topic if by_topic else ''} ---")
+    return dispatcher
+
+async def main_async(urls, ntfy_topic):
+    """Runs the refresh loop on asyncio, so slow fetches and notifications overlap."""
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, stopping.set)
+        except NotImplementedError:
+            signal.signal(signum, lambda signum, frame: loop.call_soon_threadsafe(stopping.set))
+
+    client = AsyncHTTPClient()
+    startup = asyncio.ensure_future(send_startup_notification_async(client, ntfy_topic))
+    dispatcher = AsyncNotificationDispatcher(client, outbox=open_outbox()).start()
+    subscribers, tracker, scheduler, archive, alert_stream = create_pipeline(urls, ntfy_topic, dispatcher)
+    parser = select_parser(P2000_PARSER)
+
+    while not stopping.is_set():
+        remaining = scheduler.due_in()
+        if remaining is not None and remaining > 0:
+            try:
+                await asyncio.wait_for(stopping.wait(), remaining)
+                break
+            except asyncio.TimeoutError:
+                pass
+        scheduler.begin(remaining)
+        pages = await scrape_pages_async(client, urls, tracker, parser)
+        new_count = process_alerts(pages, tracker, subscribers, dispatcher, archive, alert_stream)
+        scheduler.record(new_count, error=all(alerts is None for alerts in pages.values()))
+
+    print("\nShutdown signal received. Exiting gracefully...")
+    await startup
+    await dispatcher.shutdown(NTFY_SHUTDOWN_TIMEOUT)
+    if archive is not None:
+        await asyncio.to_thread(archive.close, NTFY_SHUTDOWN_TIMEOUT)
+    await send_shutdown_notification_async(client, ntfy_topic)
+    await client.close()
+
 def main():
     """Main function to select a region and enter the automatic refresh loop."""
-    
-    signal.signal(signal.SIGTERM, shutdown_handler)
-    signal.signal(signal.SIGINT, shutdown_handler)
-    
-    clear_screen()
+    global _waiting
 
     ntfy_topic = os.environ.get('NTFY_TOPIC')
+    if P2000_REPLAY:
+        replay(P2000_REPLAY, ntfy_topic)
+        return
+
+    clear_screen()
         
-    base_url = 'http://www.p2000-online.net/p2000.py'
-    url = f"{base_url}" 
+    urls = P2000_URLS
+    if len(urls) > 1:
+        print(f"--- Polling {len(urls)} pages: {', '.join(urls)} ---")
     
     if ntfy_topic:
-        print(f"--- Notifications will be sent to ntfy.sh/{ntfy_topic} ---")
+        print(f"--- Notifications will be sent to {NTFY_URL}/{ntfy_topic} ---")
     else:
         print("--- Notifications are disabled (NTFY_TOPIC not set) ---")
+
+    if P2000_ASYNC:
+        print(f"--- Running on asyncio ({'aiohttp' if aiohttp is not None else 'requests in threads'}) ---")
+        asyncio.run(main_async(urls, ntfy_topic))
+        return
+
+    signal.signal(signal.SIGTERM, shutdown_handler)
+    signal.signal(signal.SIGINT, shutdown_handler)
         
     send_startup_notification(ntfy_topic)
-    
-    last_alert_identifier = None
+
+    dispatcher = NotificationDispatcher(outbox=open_outbox()).start()
+    subscribers, tracker, scheduler, archive, alert_stream = create_pipeline(urls, ntfy_topic, dispatcher)
+    parser = select_parser(P2000_PARSER)
 
     while True:
-        latest_alert = scrape(url)
-
-        if latest_alert:
-            current_alert_identifier = (latest_alert['datetime'], latest_alert['message'])
-            
-            if current_alert_identifier != last_alert_identifier:
-                clear_screen()
-                print(f"--- New Alert ---")
-                last_alert_identifier = current_alert_identifier
-                
-                print(f"Time:    {latest_alert['datetime']}")
-                print(f"Service: {latest_alert['service']}")
-                print(f"Region:  {latest_alert['region']}")
-                print(f"Message: {latest_alert['message']}")
-                print("--------------------")
-                
-                if "ZOETMR" in latest_alert['service'].upper():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "ZOETMR" in latest_alert['message'].upper():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "zoetermeer" in latest_alert['service'].lower():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "zoetermeer" in latest_alert['message'].lower():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "BLEISW" in latest_alert['service'].upper():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "BLEISW" in latest_alert['message'].upper():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "bleiswijk" in latest_alert['service'].lower():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "bleiswijk" in latest_alert['message'].lower():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "DELFT" in latest_alert['message'].upper():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                elif "delft" in latest_alert['message'].lower():
-                    print("--> Service matches any of locations, attempting to send notification...")
-                    send_notification(latest_alert, ntfy_topic)
-                else:
-                    print("--> Service does not match locations, skipping notification.")
-        
-        time.sleep(1)
+        try:
+            _waiting = True
+            if _stop_requested:
+                break
+            scheduler.wait()
+        except ShutdownRequested:
+            break
+        finally:
+            _waiting = False
+        pages = scrape_pages(urls, tracker, parser)
+        new_count = process_alerts(pages, tracker, subscribers, dispatcher, archive, alert_stream)
+        scheduler.record(new_count, error=all(alerts is None for alerts in pages.values()))
+
+    print("\nShutdown signal received. Exiting gracefully...")
+    dispatcher.shutdown(NTFY_SHUTDOWN_TIMEOUT)
+    if archive is not None:
+        archive.close(NTFY_SHUTDOWN_TIMEOUT)
+    send_shutdown_notification(ntfy_topic)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
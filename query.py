@@ -0,0 +1,93 @@
+"""Searches the alert archive through its index.
+
+    python query.py zoetermeer --service Brandweer --days 7
+    python query.py "a1 rit" --region Haaglanden --since 2024-05-01 --until 2024-05-07 --json
+    python query.py --service Politie --count
+
+Words match whole words of the message case-insensitively, and an alert must
+contain all of them. The archive and index locations and the timezone of
+the dates come from the same environment variables as main.py. Before
+searching, the index is caught up with whatever was archived since it was
+last updated, so it can also be rebuilt by deleting it.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import main
+from archive import AlertIndex
+
+def day_start(value):
+    """Returns the Unix timestamp of midnight at the start of a YYYY-MM-DD day, in the alert timezone."""
+    day = datetime.strptime(value, '%Y-%m-%d')
+    if main._timezone is not None:
+        day = day.replace(tzinfo=main._timezone)
+    return day.timestamp()
+
+def day_end(value):
+    """Returns the Unix timestamp of midnight at the end of a YYYY-MM-DD day."""
+    return day_start((datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+
+def format_alert(alert):
+    return f"{alert['datetime']}  {alert['service'] or '':<10} {alert['region'] or '':<24} {alert['message']}"
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('words', nargs='*', help="words the message must contain")
+    parser.add_argument('--service', help="e.g. Brandweer, Ambulance or Politie")
+    parser.add_argument('--region', help="e.g. Haaglanden")
+    parser.add_argument('--since', type=day_start, help="first day, YYYY-MM-DD")
+    parser.add_argument('--until', type=day_end, help="last day (inclusive), YYYY-MM-DD")
+    parser.add_argument('--days', type=float, help="only the last this many days")
+    parser.add_argument('--limit', type=int, default=50, help="most alerts to show, newest first (0: all)")
+    parser.add_argument('--count', action='store_true', help="only print how many alerts match")
+    parser.add_argument('--json', action='store_true', help="print the alerts as JSON lines")
+    parser.add_argument('--archive', default=main.P2000_ARCHIVE_DIR, help="archive directory")
+    parser.add_argument('--index', help="index file (default: P2000_ARCHIVE_INDEX)")
+    parser.add_argument('--no-update', action='store_true', help="search the index without catching it up first")
+    args = parser.parse_args(argv)
+
+    if not args.archive or not os.path.isdir(args.archive):
+        parser.error(f"no archive directory at '{args.archive}'")
+    index_path = args.index or (
+        main.P2000_ARCHIVE_INDEX if args.archive == main.P2000_ARCHIVE_DIR and main.P2000_ARCHIVE_INDEX
+        else os.path.join(args.archive, 'index.sqlite3'))
+    since = args.since
+    if args.days is not None:
+        since = max(since or 0, time.time() - args.days * 86400)
+
+    index = AlertIndex(index_path, args.archive)
+    try:
+        if not args.no_update:
+            started = time.perf_counter()
+            try:
+                added = index.update()
+            except sqlite3.OperationalError as e:
+                print(f"--> Could not update the index, searching it as it is: {e}", file=sys.stderr)
+            else:
+                if added:
+                    print(f"--- Indexed {added} archived alert(s) in {time.perf_counter() - started:.2f} s ---",
+                          file=sys.stderr)
+
+        started = time.perf_counter()
+        filters = dict(text=' '.join(args.words), service=args.service, region=args.region,
+                       since=since, until=args.until)
+        if args.count:
+            found = index.count(**filters)
+            print(found)
+        else:
+            alerts = index.search(limit=args.limit, **filters)
+            for alert in alerts:
+                print(json.dumps(alert, ensure_ascii=False) if args.json else format_alert(alert))
+            found = len(alerts)
+        print(f"--- {found} alert(s) in {(time.perf_counter() - started) * 1e3:.1f} ms ---", file=sys.stderr)
+    finally:
+        index.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,364 @@
+"""Live alert stream over Server-Sent Events and WebSocket, fed by the poller.
+
+main.py publishes every new alert to an AlertStream, which serves it with
+Tornado on a thread and event loop of its own:
+
+    GET /stream          Server-Sent Events, an `alert` event per alert
+    GET /ws              WebSocket, a JSON text message per alert
+    GET /recent?n=20     the last alerts as a JSON list, newest first
+    GET /alerts?service=Brandweer&region=Haaglanden&since=2024-05-01T08:00&limit=100
+                         recent alerts filtered, newest first, with an ETag
+
+An alert is serialized once and then put on the send queue of every
+client, which a coroutine per client drains as fast as that client reads.
+Publishing never waits for a client: one whose queue is full is
+disconnected. SSE clients reconnect by themselves and get the alerts they
+missed from the buffer of recent alerts through Last-Event-ID.
+
+/alerts answers from RecentAlerts, an in-memory index of the last alerts
+by service and region. Response bodies are cached per query until the
+next alert arrives, and their ETag is a hash of the body, so a client that
+polls with If-None-Match gets a 304 without any work until an alert it
+would see comes in.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+
+try:
+    import tornado.web
+    import tornado.websocket
+    from tornado.iostream import StreamClosedError
+except ImportError:
+    tornado = None
+
+STREAM_FIELDS = ('datetime', 'service', 'region', 'message', 'capcodes', 'published_at')
+# Seconds between SSE comments on an idle stream, so proxies keep the
+# connection open and dead clients are noticed.
+KEEPALIVE_INTERVAL = 15
+# Distinct /alerts queries whose responses are cached.
+ALERTS_CACHE_SIZE = 256
+
+def parse_since(value, timezone=None):
+    """Converts a Unix timestamp or an ISO 8601 time (in `timezone` if it has no offset) to a timestamp."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None and timezone is not None:
+        moment = moment.replace(tzinfo=timezone)
+    return moment.timestamp()
+
+class RecentAlerts:
+    """The last `size` alerts, indexed by service and region (case-insensitive).
+
+    Entries are kept oldest first in one deque for all alerts and in one per
+    service and per region, so a filtered query only walks the alerts of its
+    most selective filter.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = deque()
+        self.by_service = {}
+        self.by_region = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, sequence, record, data):
+        service = (record.get('service') or '').lower()
+        region = (record.get('region') or '').lower()
+        entry = (sequence, record.get('published_at'), service, region, data)
+        self.entries.append(entry)
+        self.by_service.setdefault(service, deque()).append(entry)
+        self.by_region.setdefault(region, deque()).append(entry)
+        while len(self.entries) > self.size:
+            _, _, service, region, _ = self.entries.popleft()
+            # The evicted alert is also the oldest of its service and region.
+            for index, key in ((self.by_service, service), (self.by_region, region)):
+                index[key].popleft()
+                if not index[key]:
+                    del index[key]
+
+    def query(self, service=None, region=None, since=None, limit=100):
+        """Returns the JSON of the matching alerts, newest first."""
+        service = service.lower() if service else None
+        region = region.lower() if region else None
+        candidates = self.entries
+        if service is not None:
+            candidates = self.by_service.get(service, ())
+        if region is not None:
+            by_region = self.by_region.get(region, ())
+            if len(by_region) < len(candidates):
+                candidates = by_region
+        found = []
+        for _, published_at, entry_service, entry_region, data in reversed(candidates):
+            if service is not None and entry_service != service:
+                continue
+            if region is not None and entry_region != region:
+                continue
+            if since is not None and (published_at is None or published_at < since):
+                continue
+            found.append(data)
+            if limit and len(found) >= limit:
+                break
+        return found
+
+class AlertStream:
+    """Fans new alerts out to the connected SSE and WebSocket clients.
+
+    Keeps the last `history` alerts for /recent and for SSE clients that
+    reconnect, gives every client a queue of `client_buffer` alerts, and
+    indexes the last `index_size` alerts for /alerts. Times without an
+    offset in /alerts queries are in `timezone`.
+    """
+
+    def __init__(self, port, address='', history=100, client_buffer=1000, index_size=5000, timezone=None):
+        self.port = port
+        self.address = address
+        self.timezone = timezone
+        self.history = deque(maxlen=history)
+        self.client_buffer = client_buffer
+        self.index = RecentAlerts(index_size)
+        self.clients = set()
+        self.sequence = 0
+        self.dropped_clients = 0
+        self.api_requests = {'hit': 0, 'miss': 0, 'not_modified': 0}
+        self._cache = OrderedDict()
+        self.error = None
+        self._loop = None
+        self._ready = threading.Event()
+
+    def application(self):
+        return tornado.web.Application([
+            (r'/stream', EventStreamHandler, dict(stream=self)),
+            (r'/ws', AlertWebSocket, dict(stream=self)),
+            (r'/recent', RecentAlertsHandler, dict(stream=self)),
+            (r'/alerts', AlertsHandler, dict(stream=self)),
+        ], log_function=lambda handler: None)
+
+    def start(self):
+        """Starts serving on a background thread; returns self, or raises OSError if the port is taken."""
+        threading.Thread(target=asyncio.run, args=(self._serve(),), name="alert-stream", daemon=True).start()
+        self._ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self
+
+    async def _serve(self):
+        try:
+            self.application().listen(self.port, self.address)
+        except OSError as e:
+            self.error = e
+            self._ready.set()
+            return
+        self._loop = asyncio.get_running_loop()
+        self._ready.set()
+        await asyncio.Event().wait()
+
+    def publish(self, alert):
+        """Sends an alert to every client; safe to call from any thread, and never blocks."""
+        if self._loop is None:
+            return
+        record = {field: alert.get(field) for field in STREAM_FIELDS}
+        data = json.dumps(record, ensure_ascii=False)
+        self._loop.call_soon_threadsafe(self._publish, record, data)
+
+    def _publish(self, record, data):
+        self.sequence += 1
+        message = (self.sequence, data)
+        self.history.append(message)
+        self.index.add(self.sequence, record, data)
+        for client in list(self.clients):
+            if not client.offer(message):
+                self.clients.discard(client)
+                self.dropped_clients += 1
+                client.drop()
+
+    def since(self, last_id):
+        """Returns the buffered messages after the one with id `last_id`."""
+        return [message for message in self.history if message[0] > last_id]
+
+    def recent(self, count):
+        """Returns the JSON of the last `count` alerts, newest first."""
+        messages = list(self.history)[-count:] if count > 0 else []
+        return '[' + ','.join(data for _, data in reversed(messages)) + ']'
+
+    def alerts(self, service=None, region=None, since=None, limit=100):
+        """Returns the (etag, body) of an /alerts query, from the cache if no alert arrived since."""
+        key = ((service or '').lower(), (region or '').lower(), since, limit)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == self.sequence:
+            self._cache.move_to_end(key)
+            self.api_requests['hit'] += 1
+            return cached[1], cached[2]
+        self.api_requests['miss'] += 1
+        body = '[' + ','.join(self.index.query(service, region, since, limit)) + ']'
+        etag = '"' + hashlib.blake2b(body.encode('utf-8'), digest_size=8).hexdigest() + '"'
+        self._cache[key] = (self.sequence, etag, body)
+        self._cache.move_to_end(key)
+        if len(self._cache) > ALERTS_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return etag, body
+
+    def collect(self):
+        """Returns the stream's metric samples."""
+        by_protocol = {'sse': 0, 'websocket': 0}
+        for client in list(self.clients):
+            by_protocol[client.protocol] += 1
+        return [
+            ('p2000_stream_clients', {'protocol': protocol}, count) for protocol, count in by_protocol.items()
+        ] + [
+            ('p2000_stream_published_total', {}, self.sequence),
+            ('p2000_stream_dropped_clients_total', {}, self.dropped_clients),
+            ('p2000_api_indexed_alerts', {}, len(self.index)),
+        ] + [
+            ('p2000_api_requests_total', {'result': result}, count) for result, count in self.api_requests.items()
+        ]
+
+class ClientQueue:
+    """The bounded send queue of a client, shared by both protocols."""
+
+    protocol = None
+
+    def initialize(self, stream):
+        self.stream = stream
+        self.queue = asyncio.Queue(stream.client_buffer)
+
+    def offer(self, message):
+        """Queues a message; returns False if the client has fallen too far behind."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def take(self):
+        """Returns the queued messages, or None once the client is gone."""
+        messages = []
+        while not self.queue.empty():
+            message = self.queue.get_nowait()
+            if message is None:
+                return None
+            messages.append(message)
+        return messages
+
+    def wake(self):
+        """Wakes the sender after the client disconnected."""
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+if tornado is not None:
+
+    class EventStreamHandler(ClientQueue, tornado.web.RequestHandler):
+        protocol = 'sse'
+
+        async def get(self):
+            self.set_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.set_header('Cache-Control', 'no-cache')
+            self.set_header('X-Accel-Buffering', 'no')
+            last_id = self.request.headers.get('Last-Event-ID') or self.get_argument('last_id', None)
+            pending = self.stream.since(int(last_id)) if last_id and last_id.isdigit() else []
+            self.stream.clients.add(self)
+            try:
+                # The retry hint lets browsers come back quickly after a drop.
+                self.write("retry: 1000\n\n")
+                while True:
+                    for sequence, data in pending:
+                        self.write(f"id: {sequence}\nevent: alert\ndata: {data}\n\n")
+                    await self.flush()
+                    try:
+                        message = await asyncio.wait_for(self.queue.get(), KEEPALIVE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        self.write(":\n\n")
+                        pending = []
+                        continue
+                    # Whatever else arrived meanwhile goes out in the same write.
+                    rest = self.take() if message is not None else None
+                    if rest is None:
+                        return
+                    pending = [message] + rest
+            except StreamClosedError:
+                pass
+            finally:
+                self.stream.clients.discard(self)
+
+        def drop(self):
+            self.request.connection.close()
+
+        def on_connection_close(self):
+            self.wake()
+
+    class AlertWebSocket(ClientQueue, tornado.websocket.WebSocketHandler):
+        protocol = 'websocket'
+
+        def check_origin(self, origin):
+            # Dashboards are served from other hosts.
+            return True
+
+        def open(self):
+            self.stream.clients.add(self)
+            asyncio.ensure_future(self._send())
+
+        async def _send(self):
+            try:
+                while True:
+                    message = await self.queue.get()
+                    if message is None:
+                        return
+                    await self.write_message(message[1])
+            except tornado.websocket.WebSocketClosedError:
+                pass
+
+        def drop(self):
+            self.close(1008, "Too slow")
+            self.wake()
+
+        def on_close(self):
+            self.stream.clients.discard(self)
+            self.wake()
+
+    class RecentAlertsHandler(tornado.web.RequestHandler):
+        def initialize(self, stream):
+            self.stream = stream
+
+        def get(self):
+            try:
+                count = int(self.get_argument('n', '20'))
+            except ValueError:
+                raise tornado.web.HTTPError(400, "n must be a number")
+            self.set_header('Content-Type', 'application/json; charset=utf-8')
+            self.set_header('Cache-Control', 'no-cache')
+            self.write(self.stream.recent(count))
+
+    class AlertsHandler(tornado.web.RequestHandler):
+        def initialize(self, stream):
+            self.stream = stream
+
+        def get(self):
+            try:
+                limit = int(self.get_argument('limit', '100'))
+                if limit < 0:
+                    raise ValueError(limit)
+                since = self.get_argument('since', None)
+                since = parse_since(since, self.stream.timezone) if since else None
+            except ValueError:
+                raise tornado.web.HTTPError(400, "limit must be a number and since a Unix or ISO 8601 time")
+            etag, body = self.stream.alerts(self.get_argument('service', None), self.get_argument('region', None),
+                                            since, limit)
+            self.set_header('Content-Type', 'application/json; charset=utf-8')
+            # Clients and proxies may keep the response, but have to revalidate it.
+            self.set_header('Cache-Control', 'no-cache')
+            self.set_header('Etag', etag)
+            if self.check_etag_header():
+                self.stream.api_requests['not_modified'] += 1
+                self.set_status(304)
+                return
+            self.write(body)